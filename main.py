@@ -1,19 +1,36 @@
 import os
+import sys
+import asyncio
+import argparse
 import logging
 import threading
+import multiprocessing
+import signal
+import hmac
 import re
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from collections import deque
-from openai import OpenAI
+import time
+import json
+import sqlite3
+import importlib.util
+import functools
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, OrderedDict, deque
+from queue import Empty
+import openai
+from openai import AsyncOpenAI
 import httpx
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from telegram import Update, Message
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
@@ -24,20 +41,948 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ─── Трассировка ─────────────────────────────────────────────────────────────
+
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "1") == "1"
+# Апдейты дольше этого порога пишутся в slow-лог с разбивкой по стадиям
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 10))
+# Если задан — все трассы дописываются сюда построчно в JSON
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+
+slow_logger = logging.getLogger("lensbot.slow")
+
+
+class Trace:
+    """Трасса одного апдейта: список завершённых стадий со смещениями от начала."""
+    __slots__ = ("trace_id", "name", "attrs", "started", "spans")
+
+    def __init__(self, name: str, attrs: dict):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.spans: list[tuple] = []
+
+    def add_span(self, name: str, started: float, duration: float, labels: dict, error: bool) -> None:
+        self.spans.append((name, started - self.started, duration, labels, error))
+
+    def as_dict(self, duration: float) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "attrs": self.attrs,
+            "duration_ms": round(duration * 1000, 1),
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round(offset * 1000, 1),
+                    "duration_ms": round(span * 1000, 1),
+                    **({"labels": labels} if labels else {}),
+                    **({"error": True} if error else {}),
+                }
+                for name, offset, span, labels, error in sorted(self.spans, key=lambda s: s[1])
+            ],
+        }
+
+
+current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def traced(name: str, **attrs):
+    """Открывает трассу на время обработки апдейта; при выключенной трассировке ничего не делает."""
+    if not TRACE_ENABLED:
+        yield None
+        return
+    trace = Trace(name, attrs)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+        finish_trace(trace, time.perf_counter() - trace.started)
+
+
+def finish_trace(trace: Trace, duration: float) -> None:
+    if duration < SLOW_REQUEST_SECONDS and not TRACE_EXPORT_PATH:
+        return
+    record = json.dumps(trace.as_dict(duration), ensure_ascii=False)
+    if duration >= SLOW_REQUEST_SECONDS:
+        slow_logger.warning(record)
+    if TRACE_EXPORT_PATH:
+        try:
+            with open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+                f.write(record + "\n")
+        except OSError as e:
+            logger.warning(f"trace export error: {e}")
+
+
+# ─── Метрики ─────────────────────────────────────────────────────────────────
+
+class Metrics:
+    """Счётчики, гейджи и гистограммы, отдаются в текстовом формате Prometheus."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types: dict[str, str] = {}
+        self._values: dict[tuple, float] = {}
+        self._histograms: dict[tuple, list] = {}  # ключ → [счётчики корзин..., сумма, количество]
+        self.collectors = []  # функции, добавляющие значения из других подсистем перед выдачей
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._types.setdefault(name, "counter")
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._types.setdefault(name, "gauge")
+            self._values[self._key(name, labels)] = value
+
+    def set_counter(self, name: str, value: float, **labels) -> None:
+        """Счётчик, который ведёт сама подсистема: просто берём его текущее значение."""
+        with self._lock:
+            self._types.setdefault(name, "counter")
+            self._values[self._key(name, labels)] = value
+
+    def add(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._types.setdefault(name, "gauge")
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._types.setdefault(name, "histogram")
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @contextmanager
+    def stage(self, stage: str, **labels):
+        """Время стадии конвейера в lensbot_stage_seconds, исключения — в lensbot_stage_errors_total.
+
+        Если идёт трассировка апдейта, стадия попадает в неё спаном.
+        """
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            self.inc("lensbot_stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            self.observe("lensbot_stage_seconds", duration, stage=stage, **labels)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add_span(stage, started, duration, labels, error)
+
+    @contextmanager
+    def in_flight(self, kind: str):
+        self.add("lensbot_in_flight", 1, kind=kind)
+        try:
+            yield
+        finally:
+            self.add("lensbot_in_flight", -1, kind=kind)
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                collect(self)
+            except Exception as e:
+                logger.warning(f"metrics collector error: {e}")
+
+        def fmt(labels, extra=()) -> str:
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            for name, kind in sorted(self._types.items()):
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "histogram":
+                    for (n, labels), hist in sorted(self._histograms.items()):
+                        if n != name:
+                            continue
+                        for bound, count in zip(self.BUCKETS, hist):
+                            lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {count}")
+                        lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {hist[-1]}")
+                        lines.append(f"{name}_sum{fmt(labels)} {hist[-2]:.6f}")
+                        lines.append(f"{name}_count{fmt(labels)} {hist[-1]}")
+                else:
+                    for (n, labels), value in sorted(self._values.items()):
+                        if n == name:
+                            lines.append(f"{name}{fmt(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# ─── Устойчивость к сбоям источников ─────────────────────────────────────────
+
+# Базовая пауза перед повтором; растёт вдвое с каждой попыткой, со случайным разбросом
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 0.3))
+
+RETRYABLE_ERRORS = (
+    httpx.TransportError,
+    httpx.HTTPStatusError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    TimeoutError,
+)
+
+
+class UpstreamUnavailable(Exception):
+    """Источник отключён предохранителем или не уложился в лимит запросов."""
+
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду, до burst подряд."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def take(self, deadline: float | None = None) -> bool:
+        """Ждёт токен; False — если до дедлайна (время цикла событий) его не дождаться."""
+        loop = asyncio.get_running_loop()
+        while not self.try_take():
+            wait = self.wait_time()
+            if deadline is not None and loop.time() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+        return True
+
+
+class CircuitBreaker:
+    """После threshold сбоев подряд источник пропускается; раз в reset_timeout — пробный запрос."""
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.probing else "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.probing = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def abandon(self) -> None:
+        """Пробный запрос не дал ответа ни в ту, ни в другую сторону."""
+        self.probing = False
+
+
+class Upstream:
+    """Лимит запросов, повторы с учётом дедлайна и предохранитель для одного источника.
+
+    Лимит адаптивный: на 429 скорость падает вдвое, на успехах плавно
+    возвращается к исходной.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, retries: int,
+                 failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.max_rate = rate
+        self.retries = retries
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def scale(self, share: float) -> None:
+        """Оставляет процессу долю лимита, когда источник делят несколько воркеров."""
+        self.max_rate *= share
+        self.bucket.rate *= share
+
+    async def call(self, factory, deadline: float | None = None):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                metrics.inc("lensbot_upstream_rejected_total", upstream=self.name, reason="circuit_open")
+                raise UpstreamUnavailable(f"{self.name}: circuit open")
+            if not await self.bucket.take(deadline):
+                self.breaker.abandon()
+                metrics.inc("lensbot_upstream_rejected_total", upstream=self.name, reason="rate_limit")
+                raise UpstreamUnavailable(f"{self.name}: rate limit")
+
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                async with asyncio.timeout(timeout):
+                    result = await factory()
+            except RETRYABLE_ERRORS as e:
+                self.breaker.failure()
+                metrics.inc("lensbot_upstream_failures_total", upstream=self.name)
+                if _is_throttled(e):
+                    self.bucket.rate = max(self.max_rate / 10, self.bucket.rate / 2)
+                delay = RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+                if attempt == self.retries or (deadline is not None and loop.time() + delay >= deadline):
+                    raise
+                metrics.inc("lensbot_upstream_retries_total", upstream=self.name)
+                logger.info(f"{self.name}: повтор через {delay:.2f}s после {type(e).__name__}")
+                await asyncio.sleep(delay)
+            except BaseException:
+                self.breaker.abandon()
+                raise
+            else:
+                self.breaker.success()
+                self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate * 0.1)
+                return result
+
+
+def _is_throttled(error: Exception) -> bool:
+    if isinstance(error, openai.RateLimitError):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429
+
+
+# Потолок запросов к DeepSeek в секунду со всего процесса
+DEEPSEEK_RATE = float(os.environ.get("DEEPSEEK_RATE", 20))
+
+UPSTREAMS = {
+    "deepseek": Upstream("deepseek", rate=DEEPSEEK_RATE, burst=DEEPSEEK_RATE * 2, retries=2),
+    "duckduckgo": Upstream("duckduckgo", rate=1, burst=4, retries=1, failure_threshold=3, reset_timeout=60),
+    "photozone.de": Upstream("photozone.de", rate=2, burst=4, retries=1, failure_threshold=3),
+    "prophotos.ru": Upstream("prophotos.ru", rate=2, burst=4, retries=1, failure_threshold=3),
+}
+
+UPSTREAM_HOSTS = {
+    "html.duckduckgo.com": "duckduckgo",
+    "photozone.de": "photozone.de",
+    "www.photozone.de": "photozone.de",
+    "prophotos.ru": "prophotos.ru",
+    "www.prophotos.ru": "prophotos.ru",
+}
+
+# Абсолютный дедлайн (время цикла событий) текущего поиска; наследуется задачами
+fetch_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("fetch_deadline", default=None)
+
+
+# ─── Общее состояние воркеров ────────────────────────────────────────────────
+
+# memory — в памяти процесса (один воркер); sqlite — общий файл для воркеров
+# на одной машине; redis — Redis или совместимый сервер для нескольких машин
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_PATH = os.environ.get("STATE_PATH", "state.sqlite3")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.environ.get("REDIS_PREFIX", "lensbot:")
+
+
+class MemoryState:
+    """Состояние в памяти процесса.
+
+    Интерфейс общий для всех бэкендов: строки по ключу с TTL, set(nx=True)
+    для блокировок и атомарное ведро токенов take_token, которое списывает
+    токен и возвращает 0 или, если токена нет, сколько секунд его ждать.
+    """
+
+    shared = False
+
+    def __init__(self, max_keys: int = 50000):
+        self.max_keys = max_keys
+        self._values: dict[str, tuple[float | None, str]] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+
+    async def get(self, key: str) -> str | None:
+        item = self._values.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires is not None and expires < time.time():
+            del self._values[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: str, ttl: float | None = None, nx: bool = False) -> bool:
+        if nx and await self.get(key) is not None:
+            return False
+        if len(self._values) >= self.max_keys:
+            now = time.time()
+            for k in [k for k, (expires, _) in self._values.items() if expires is not None and expires < now]:
+                del self._values[k]
+        self._values[key] = (time.time() + ttl if ttl else None, value)
+        return True
+
+    async def delete(self, key: str) -> None:
+        self._values.pop(key, None)
+
+    async def take_token(self, key: str, rate: float, burst: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                # Полное ведро ничем не отличается от нового — такие можно забыть
+                for k in [k for k, b in self._buckets.items() if b.wait_time() == 0 and b.tokens >= b.burst]:
+                    del self._buckets[k]
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        bucket.rate, bucket.burst = rate, burst
+        return 0.0 if bucket.try_take() else bucket.wait_time()
+
+    async def close(self) -> None:
+        pass
+
+
+class SqliteFile:
+    """SQLite-файл, который могут делить воркеры: WAL, ожидание чужой записи
+    и отдельный поток для запросов, чтобы блокировка не вешала event loop.
+
+    Поток один на соединение, так что транзакции не перемешиваются.
+    """
+
+    def __init__(self, path: str, name: str):
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+
+class SqliteState:
+    """Состояние в SQLite-файле, общем для воркеров на одной машине.
+
+    Запросы идут в отдельном потоке: BEGIN IMMEDIATE может ждать чужую
+    запись до 10 секунд, и event loop на это время вставать не должен.
+    Поток один, так что транзакции одного процесса не перемешиваются.
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)"
+        )
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._takes = 0
+        self._purge()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _purge(self) -> None:
+        now = time.time()
+        self.db.execute("DELETE FROM kv WHERE expires < ?", (now,))
+        self.db.execute("DELETE FROM buckets WHERE full_at < ?", (now,))
+
+    def _get(self, key: str) -> str | None:
+        row = self.db.execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str, ttl: float | None, nx: bool) -> bool:
+        now = time.time()
+        expires = now + ttl if ttl else None
+        if not nx:
+            self.db.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+            return True
+        # Перезаписываем только протухшее значение — одним атомарным UPSERT
+        cursor = self.db.execute(
+            "INSERT INTO kv (key, value, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires = excluded.expires "
+            "WHERE kv.expires IS NOT NULL AND kv.expires <= ?",
+            (key, value, expires, now),
+        )
+        return cursor.rowcount > 0
+
+    def _delete(self, key: str) -> None:
+        self.db.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def _take_token(self, key: str, rate: float, burst: float) -> float:
+        self._takes += 1
+        if self._takes % 1000 == 0:
+            self._purge()
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            if tokens < 1:
+                self.db.execute("COMMIT")
+                return (1 - tokens) / rate
+            tokens -= 1
+            self.db.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                (key, tokens, now, now + (burst - tokens) / rate),
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return 0.0
+
+    async def get(self, key: str) -> str | None:
+        return await self._run(self._get, key)
+
+    async def set(self, key: str, value: str, ttl: float | None = None, nx: bool = False) -> bool:
+        return await self._run(self._set, key, value, ttl, nx)
+
+    async def delete(self, key: str) -> None:
+        await self._run(self._delete, key)
+
+    async def take_token(self, key: str, rate: float, burst: float) -> float:
+        return await self._run(self._take_token, key, rate, burst)
+
+    async def close(self) -> None:
+        await self._run(self.db.close)
+        self._executor.shutdown()
+
+
+_TAKE_TOKEN_LUA = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+if tokens < 1 then
+    return tostring((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return '0'
+"""
+
+
+class RedisState:
+    """Состояние в Redis: воркеры могут жить на разных машинах.
+
+    Подойдёт любой сервер с протоколом Redis и EVAL — например, локальный
+    redis-server или Valkey для проверки.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str):
+        # Необязательная зависимость: нужна только с STATE_BACKEND=redis
+        import redis.asyncio
+
+        self.redis = redis.asyncio.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self._take_token = self.redis.register_script(_TAKE_TOKEN_LUA)
+
+    async def get(self, key: str) -> str | None:
+        return await self.redis.get(self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: float | None = None, nx: bool = False) -> bool:
+        px = int(ttl * 1000) if ttl else None
+        return bool(await self.redis.set(self.prefix + key, value, px=px, nx=nx))
+
+    async def delete(self, key: str) -> None:
+        await self.redis.delete(self.prefix + key)
+
+    async def take_token(self, key: str, rate: float, burst: float) -> float:
+        # Время клиента, а не TIME сервера: скрипт остаётся детерминированным
+        wait = await self._take_token(keys=[self.prefix + "bucket:" + key], args=[rate, burst, time.time()])
+        return float(wait)
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+
+def make_state():
+    if STATE_BACKEND == "sqlite":
+        return SqliteState(STATE_PATH)
+    if STATE_BACKEND == "redis":
+        return RedisState(REDIS_URL, REDIS_PREFIX)
+    return MemoryState()
+
+
+state = make_state()
+
+
 TELEGRAM_TOKEN = os.environ["TELEGRAM_TOKEN"]
 DEEPSEEK_API_KEY = os.environ["DEEPSEEK_API_KEY"]
 
-client = OpenAI(
+client = AsyncOpenAI(
     api_key=DEEPSEEK_API_KEY,
-    base_url="https://api.deepseek.com",
+    base_url=os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
+    # Повторами занимается Upstream
+    max_retries=0,
+)
+
+# Сколько всего ждать DeepSeek на один вызов, включая повторы
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", 60))
+
+# Сколько запросов к DeepSeek может выполняться одновременно
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 8))
+# Сколько апдейтов Telegram обрабатывается параллельно
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))
+
+# Флуд-контроль: запросов к модели в секунду и запас подряд на пользователя и на чат
+USER_LLM_RATE = float(os.environ.get("USER_LLM_RATE", 0.2))
+USER_LLM_BURST = float(os.environ.get("USER_LLM_BURST", 6))
+CHAT_LLM_RATE = float(os.environ.get("CHAT_LLM_RATE", 0.5))
+CHAT_LLM_BURST = float(os.environ.get("CHAT_LLM_BURST", 12))
+# Сколько интерактивный запрос может ждать своей квоты, прежде чем его отбросят
+FLOOD_MAX_WAIT = float(os.environ.get("FLOOD_MAX_WAIT", 5))
+# Об отброшенном ответе говорим чату не чаще раза в столько секунд, дальше молчим
+SHED_NOTICE_INTERVAL = float(os.environ.get("SHED_NOTICE_INTERVAL", 60))
+# Сколько фоновых запросов может стоять в очереди; остальные отбрасываются
+LLM_BACKGROUND_QUEUE = int(os.environ.get("LLM_BACKGROUND_QUEUE", 4))
+
+INTERACTIVE, BACKGROUND = 0, 1
+LLM_PRIORITIES = {"reply": INTERACTIVE, "extract": INTERACTIVE, "mistake": BACKGROUND, "summary": BACKGROUND}
+
+# (user_id, chat_id) апдейта, ради которого идёт запрос к модели
+llm_caller: contextvars.ContextVar[tuple[int | None, int | None]] = contextvars.ContextVar(
+    "llm_caller", default=(None, None)
 )
 
+
+class Shed(Exception):
+    """Запрос к модели отброшен планировщиком."""
+
+
+class LLMScheduler:
+    """Слоты DeepSeek с приоритетами, честной очередью по чатам и флуд-контролем.
+
+    Свободный слот достаётся сначала интерактивным запросам, затем фоновым;
+    внутри приоритета чаты обслуживаются по кругу, так что один активный чат
+    не занимает все слоты.
+    """
+
+    def __init__(self, slots: int):
+        self.free = slots
+        # приоритет -> chat_id -> ожидающие
+        self._queues: list[OrderedDict[int | None, deque[asyncio.Future]]] = [OrderedDict(), OrderedDict()]
+
+    def queued(self, priority: int) -> int:
+        return sum(len(q) for q in self._queues[priority].values())
+
+    async def _flood_control(self, purpose: str, priority: int, user_id: int | None, chat_id: int | None) -> None:
+        # Вёдра в общем состоянии: пользователь пишет в разные чаты, а их ведут разные воркеры
+        buckets = []
+        if chat_id is not None:
+            buckets.append((f"flood:chat:{chat_id}", CHAT_LLM_RATE, CHAT_LLM_BURST))
+        if user_id is not None:
+            buckets.append((f"flood:user:{user_id}", USER_LLM_RATE, USER_LLM_BURST))
+        # Жетон не бронируется: после сна его может забрать сосед, тогда ждём снова.
+        # Общее ожидание по всем вёдрам не больше FLOOD_MAX_WAIT
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deferred = False
+        for key, rate, burst in buckets:
+            while (wait := await state.take_token(key, rate, burst)) > 0:
+                if priority == BACKGROUND or loop.time() - started + wait > FLOOD_MAX_WAIT:
+                    metrics.inc("lensbot_llm_scheduled_total", purpose=purpose, outcome="shed_flood")
+                    raise Shed(f"флуд-контроль: user={user_id} chat={chat_id}")
+                if not deferred:
+                    deferred = True
+                    metrics.inc("lensbot_llm_scheduled_total", purpose=purpose, outcome="deferred")
+                await asyncio.sleep(wait)
+
+    async def acquire(self, purpose: str) -> None:
+        priority = LLM_PRIORITIES.get(purpose, INTERACTIVE)
+        user_id, chat_id = llm_caller.get()
+        await self._flood_control(purpose, priority, user_id, chat_id)
+
+        if self.free > 0 and not any(self._queues):
+            self.free -= 1
+            metrics.inc("lensbot_llm_scheduled_total", purpose=purpose, outcome="admitted")
+            return
+        if priority == BACKGROUND and (self._queues[INTERACTIVE] or self.queued(BACKGROUND) >= LLM_BACKGROUND_QUEUE):
+            metrics.inc("lensbot_llm_scheduled_total", purpose=purpose, outcome="shed_load")
+            raise Shed("фоновый запрос отброшен под нагрузкой")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(chat_id, deque()).append(waiter)
+        metrics.inc("lensbot_llm_scheduled_total", purpose=purpose, outcome="queued")
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже выдан, но ждать его больше некому
+                self.release()
+            else:
+                self._forget(priority, chat_id, waiter)
+            raise
+
+    def _forget(self, priority: int, chat_id: int | None, waiter: asyncio.Future) -> None:
+        queue = self._queues[priority]
+        waiters = queue.get(chat_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del queue[chat_id]
+
+    def release(self) -> None:
+        for queue in self._queues:
+            while queue:
+                chat_id, waiters = next(iter(queue.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    queue.move_to_end(chat_id)
+                else:
+                    del queue[chat_id]
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.free += 1
+
+
+llm_scheduler = LLMScheduler(LLM_CONCURRENCY)
+
+
+def record_usage(usage, purpose: str) -> None:
+    if usage is None:
+        return
+    metrics.inc("lensbot_llm_tokens_total", usage.prompt_tokens, kind="prompt", purpose=purpose)
+    metrics.inc("lensbot_llm_tokens_total", usage.completion_tokens, kind="completion", purpose=purpose)
+
+
+async def complete(purpose: str = "reply", **kwargs):
+    """Запрос к DeepSeek через планировщик слотов."""
+    with metrics.in_flight("llm_waiting"):
+        await llm_scheduler.acquire(purpose)
+    try:
+        with metrics.in_flight("llm"), metrics.stage("completion", purpose=purpose):
+            response = await UPSTREAMS["deepseek"].call(
+                lambda: client.chat.completions.create(model="deepseek-chat", **kwargs),
+                deadline=asyncio.get_running_loop().time() + LLM_DEADLINE,
+            )
+    finally:
+        llm_scheduler.release()
+    record_usage(response.usage, purpose)
+    return response
+
+
+async def stream_complete(purpose: str = "reply", **kwargs):
+    """Потоковый запрос к DeepSeek: отдаёт куски текста, держа слот до конца генерации."""
+    with metrics.in_flight("llm_waiting"):
+        await llm_scheduler.acquire(purpose)
+    try:
+        with metrics.in_flight("llm"), metrics.stage("completion", purpose=purpose):
+            started = time.perf_counter()
+            first = True
+            # Дедлайн общий на открытие и чтение: зависший поток не должен держать слот
+            deadline = asyncio.get_running_loop().time() + LLM_DEADLINE
+            stream = await UPSTREAMS["deepseek"].call(
+                lambda: client.chat.completions.create(
+                    model="deepseek-chat", stream=True, stream_options={"include_usage": True}, **kwargs
+                ),
+                deadline=deadline,
+            )
+            try:
+                while True:
+                    # Таймаут только вокруг чтения: между кусками управление у того, кто читает нас
+                    try:
+                        async with asyncio.timeout_at(deadline):
+                            chunk = await anext(stream)
+                    except StopAsyncIteration:
+                        break
+                    if getattr(chunk, "usage", None):
+                        record_usage(chunk.usage, purpose)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first:
+                            metrics.observe("lensbot_llm_first_token_seconds", time.perf_counter() - started)
+                            first = False
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+    finally:
+        llm_scheduler.release()
+
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
                   "(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
     "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
 }
 
+# ─── HTTP-клиент для скрапинга ───────────────────────────────────────────────
+
+# HTTP/2 включаем, только если установлен h2 (pip install httpx[http2])
+HTTP2 = importlib.util.find_spec("h2") is not None
+# Одновременных соединений к одному хосту
+PER_HOST_CONNECTIONS = int(os.environ.get("PER_HOST_CONNECTIONS", 4))
+# Общий дедлайн на поиск и парсинг обоих сайтов
+FETCH_DEADLINE = float(os.environ.get("FETCH_DEADLINE", 8))
+# Сколько ждать остальные сайты после первого удачного ответа
+FETCH_GRACE = float(os.environ.get("FETCH_GRACE", 1.5))
+
+http_client = httpx.AsyncClient(
+    headers=HEADERS,
+    timeout=10,
+    follow_redirects=True,
+    http2=HTTP2,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60),
+)
+
+_host_slots: dict[str, asyncio.Semaphore] = {}
+
+
+async def http_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Запрос через общий пул соединений с лимитом на хост.
+
+    Для известных источников — через их Upstream: лимит, повторы в пределах
+    fetch_deadline, предохранитель.
+    """
+    host = httpx.URL(url).host
+    slots = _host_slots.setdefault(host, asyncio.Semaphore(PER_HOST_CONNECTIONS))
+
+    async def send() -> httpx.Response:
+        async with slots:
+            r = await http_client.request(method, url, **kwargs)
+        if r.status_code == 429 or r.status_code >= 500:
+            r.raise_for_status()
+        return r
+
+    upstream = UPSTREAMS.get(UPSTREAM_HOSTS.get(host, ""))
+    if upstream is None:
+        return await send()
+    return await upstream.call(send, deadline=fetch_deadline.get())
+
+
+async def close_http_client(app: Application) -> None:
+    await http_client.aclose()
+
+
+# ─── Пул для CPU-работы ──────────────────────────────────────────────────────
+
+# Где выполнять стадии: process — пул процессов (парсинг не упирается в GIL),
+# thread — пул потоков, inline — прямо в цикле событий
+CPU_BACKENDS = {
+    "parse": os.environ.get("CPU_BACKEND_PARSE", "process"),
+    "regex": os.environ.get("CPU_BACKEND_REGEX", "inline"),
+}
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", min(4, os.cpu_count() or 1)))
+# Сколько задач может ждать или выполняться в пулах; дальше вызывающие ждут
+CPU_QUEUE_LIMIT = int(os.environ.get("CPU_QUEUE_LIMIT", 32))
+
+
+class CPUExecutor:
+    """Выносит CPU-тяжёлые стадии из цикла событий с ограниченной очередью."""
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.depth: Counter = Counter()
+        self._pools: dict[str, Executor] = {}
+        self._slots: asyncio.Semaphore | None = None
+
+    def _pool(self, backend: str) -> Executor:
+        pool = self._pools.get(backend)
+        if pool is None:
+            if backend == "process":
+                pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu")
+            self._pools[backend] = pool
+        return pool
+
+    async def run(self, stage: str, fn, *args):
+        backend = CPU_BACKENDS.get(stage, "inline")
+        started = time.perf_counter()
+        if backend == "inline":
+            result = fn(*args)
+        else:
+            if self._slots is None:
+                self._slots = asyncio.Semaphore(self.queue_limit)
+            self.depth[stage] += 1
+            try:
+                async with self._slots:
+                    loop = asyncio.get_running_loop()
+                    result = await loop.run_in_executor(self._pool(backend), fn, *args)
+            finally:
+                self.depth[stage] -= 1
+        # Вместе с ожиданием в очереди пула: столько стадия стоила ответу
+        metrics.observe("lensbot_cpu_seconds", time.perf_counter() - started, stage=stage, backend=backend)
+        return result
+
+    def shutdown(self) -> None:
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._pools.clear()
+
+
+cpu_pool = CPUExecutor(CPU_WORKERS, CPU_QUEUE_LIMIT)
+
+
+# ─── Сопоставление с шаблонами ───────────────────────────────────────────────
+
+class PatternMatcher:
+    """Набор регулярок, скомпилированный в одну альтернацию.
+
+    Один проход по тексту вместо re.search на каждое правило. Отдельные
+    правила прогоняются только при совпадении, чтобы узнать, какое из них
+    сработало.
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.patterns = list(patterns)
+        self.compiled = [re.compile(p) for p in self.patterns]
+        self.regex = re.compile("|".join(f"(?:{p})" for p in self.patterns))
+
+    def search(self, text: str) -> str | None:
+        if self.regex.search(text) is None:
+            return None
+        for pattern, compiled in zip(self.patterns, self.compiled):
+            if compiled.search(text):
+                return pattern
+        return None
+
+
 # ─── Защита ───────────────────────────────────────────────────────────────────
 
 HACK_PATTERNS = [
@@ -74,9 +1019,16 @@ HACK_RESPONSES = [
 ]
 
 
+hack_matcher = PatternMatcher(HACK_PATTERNS)
+
+
+def match_hack(text: str) -> str | None:
+    """Правило из HACK_PATTERNS, на которое сработал текст, или None."""
+    return hack_matcher.search(text.lower())
+
+
 def is_hack_attempt(text: str) -> bool:
-    text_lower = text.lower()
-    return any(re.search(p, text_lower) for p in HACK_PATTERNS)
+    return match_hack(text) is not None
 
 
 def get_hack_response() -> str:
@@ -122,52 +1074,390 @@ MISTAKE_PROMPT = """Ты опытный фотограф и знаток опт
 - Иначе — поправь коротко, по-дружески, 1-2 предложения, без форматирования
 """
 
-private_histories: dict[int, deque] = {}
-group_histories: dict[int, deque] = {}
+MISTAKE_BATCH_PROMPT = """Ты опытный фотограф и знаток оптики. Тебе дают пронумерованные сообщения из фото-чата.
+
+Найди в них фактические технические ошибки по теме фото/оптики.
+
+Вмешайся если видишь: неправильный кроп-фактор, перепутанную работу диафрагмы/ISO/выдержки, неверную совместимость байонетов, очевидно неверные характеристики известного объектива/камеры, путаницу в физике оптики.
+
+Не вмешивайся если: мнение, вопрос, не про фото/оптику, есть хоть малейшие сомнения.
+
+Ответь ТОЛЬКО:
+- SKIP — если ошибок нет ни в одном сообщении или не уверен
+- Иначе — по строке на каждое сообщение с ошибкой в формате "<номер>: <поправка>", поправка коротко, по-дружески, 1-2 предложения, без форматирования
+"""
 
 MAX_HISTORY = 30
 MAX_TOKENS = 400
 
 
-# ─── Извлечение названия объектива ───────────────────────────────────────────
+# ─── Кэш данных об объективах ────────────────────────────────────────────────
+
+LENS_CACHE_PATH = os.environ.get("LENS_CACHE_PATH", "lens_cache.sqlite3")
+LENS_CACHE_SIZE = int(os.environ.get("LENS_CACHE_SIZE", 512))
+# Найденные данные живут неделю, «ничего не нашли» — несколько часов
+LENS_CACHE_TTL = int(os.environ.get("LENS_CACHE_TTL", 7 * 24 * 3600))
+LENS_CACHE_NEGATIVE_TTL = int(os.environ.get("LENS_CACHE_NEGATIVE_TTL", 6 * 3600))
+
+_MISSING = object()
+
+
+def normalize_lens_name(name: str) -> str:
+    """Ключ для кэша: регистр, пробелы, «мм»/«mm» и «f/» не важны."""
+    text = name.lower().replace("ё", "е")
+    text = re.sub(r"(\d)\s*(?:mm|мм)\b", r"\1mm", text)
+    text = re.sub(r"\bf\s*/\s*(?=\d)", "f", text)
+    text = re.sub(r"[^\w.\-/]+", " ", text)
+    return " ".join(text.split())
+
+
+class TTLCache:
+    """LRU-словарь в памяти с временем жизни записей."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time.time():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float) -> None:
+        self._data[key] = (time.time() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key) -> None:
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class LensCache:
+    """Кэш результатов fetch_lens_data: LRU в памяти поверх SQLite-файла."""
+
+    def __init__(self, path: str | None, maxsize: int, shared=None):
+        self.memory = TTLCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+        # Общее состояние воркеров — третий уровень после памяти и файла
+        self.shared = shared
+        self.file = None
+        if path:
+            self.file = SqliteFile(path, "lens-cache")
+            self.file.db.execute(
+                "CREATE TABLE IF NOT EXISTS lens_cache ("
+                "key TEXT PRIMARY KEY, data TEXT, expires REAL NOT NULL)"
+            )
+            self.file.db.execute("DELETE FROM lens_cache WHERE expires < ?", (time.time(),))
+            self.file.db.commit()
 
-def extract_lens_name(text: str) -> str | None:
-    try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Из текста извлеки название конкретного объектива или камеры для поиска.\n"
-                        "Верни ТОЛЬКО краткое название модели, например: 'Helios 44-2 58mm', 'Canon 50mm f1.8 STM', 'Sigma 35mm Art'.\n"
-                        "Если конкретного объектива или камеры нет — верни: NONE\n"
-                        "Только название или NONE, без пояснений."
-                    ),
-                },
-                {"role": "user", "content": text},
-            ],
-            max_tokens=30,
-            temperature=0,
+    def _db_get(self, key: str):
+        return self.file.db.execute("SELECT data, expires FROM lens_cache WHERE key = ?", (key,)).fetchone()
+
+    def _db_set(self, key: str, data: str | None, expires: float) -> None:
+        self.file.db.execute(
+            "INSERT OR REPLACE INTO lens_cache (key, data, expires) VALUES (?, ?, ?)", (key, data, expires)
         )
-        result = response.choices[0].message.content.strip()
-        if result.upper() == "NONE" or not result:
+        self.file.db.commit()
+
+    async def get(self, key: str):
+        """Возвращает данные (None — закэшированный промах) или _MISSING."""
+        value = self.memory.get(key, _MISSING)
+        if value is _MISSING and self.file is not None:
+            try:
+                row = await self.file.run(self._db_get, key)
+            except sqlite3.Error as e:
+                # Файл занят другим воркером — считаем промахом, поиск всё равно ответит
+                logger.warning(f"Кэш объективов: ошибка чтения '{key}': {e}")
+                row = None
+            if row and row[1] > time.time():
+                value = row[0]
+                self.memory.set(key, value, row[1] - time.time())
+        if value is _MISSING and self.shared is not None:
+            raw = await self.shared.get(f"lens:{key}")
+            if raw is not None:
+                value = json.loads(raw)
+                self.memory.set(key, value, LENS_CACHE_TTL if value else LENS_CACHE_NEGATIVE_TTL)
+        if value is _MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, data: str | None) -> None:
+        ttl = LENS_CACHE_TTL if data else LENS_CACHE_NEGATIVE_TTL
+        self.memory.set(key, data, ttl)
+        if self.file is not None:
+            try:
+                await self.file.run(self._db_set, key, data, time.time() + ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"Кэш объективов: ошибка записи '{key}': {e}")
+        if self.shared is not None:
+            await self.shared.set(f"lens:{key}", json.dumps(data, ensure_ascii=False), ttl)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "size": len(self.memory),
+        }
+
+
+class SingleFlight:
+    """Склеивает одновременные вызовы с одним ключом в один.
+
+    Первый вызов запускает работу, остальные ждут его результат. Работа
+    идёт отдельной задачей, так что отмена одного из ждущих её не прерывает.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    async def run(self, key: str, factory):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+
+lens_cache = LensCache(LENS_CACHE_PATH, LENS_CACHE_SIZE, state if state.shared else None)
+lens_flight = SingleFlight()
+
+# Сколько держим межпроцессную блокировку поиска объектива
+LENS_FETCH_LOCK_TTL = FETCH_DEADLINE + FETCH_GRACE + 5
+
+
+async def wait_for_peer_fetch(key: str, lock: str):
+    """Ждёт, пока другой воркер закончит поиск, и берёт результат из кэша; _MISSING — не дождались."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LENS_FETCH_LOCK_TTL
+    while loop.time() < deadline:
+        await asyncio.sleep(0.2)
+        if await state.get(lock) is None:
+            return await lens_cache.get(key)
+    return _MISSING
+
+
+async def lookup_lens_data(lens_name: str) -> str | None:
+    """fetch_lens_data через кэш по нормализованному названию.
+
+    Одновременные запросы одного и того же объектива идут одним поиском,
+    в том числе из разных воркеров при общем состоянии.
+    """
+    key = normalize_lens_name(lens_name)
+    data = await lens_cache.get(key)
+    if data is not _MISSING:
+        logger.info(f"Кэш объективов: попадание '{key}' {lens_cache.stats()}")
+        return data
+
+    async def fetch():
+        lock = f"inflight:lens:{key}"
+        owner = not state.shared or await state.set(lock, "1", ttl=LENS_FETCH_LOCK_TTL, nx=True)
+        if not owner:
+            metrics.inc("lensbot_singleflight_remote_total")
+            data = await wait_for_peer_fetch(key, lock)
+            if data is not _MISSING:
+                return data
+        try:
+            result = await fetch_lens_data(lens_name)
+            await lens_cache.set(key, result)
+        except LensSearchIncomplete as e:
+            # Временный сбой источника не должен на часы запоминаться как «обзора нет»
+            metrics.inc("lensbot_lens_search_incomplete_total")
+            logger.warning(f"Поиск '{key}' не завершён ({e}), в кэш не кладём")
             return None
-        logger.info(f"Извлечено название: '{result}'")
+        finally:
+            if owner and state.shared:
+                await state.delete(lock)
+        logger.info(f"Кэш объективов: промах '{key}' {lens_cache.stats()}")
         return result
-    except Exception as e:
-        logger.warning(f"extract_lens_name error: {e}")
+
+    return await lens_flight.run(key, fetch)
+
+
+# ─── Извлечение названия объектива ───────────────────────────────────────────
+
+LENS_NAME_MEMO_SIZE = int(os.environ.get("LENS_NAME_MEMO_SIZE", 1024))
+LENS_NAME_MEMO_TTL = int(os.environ.get("LENS_NAME_MEMO_TTL", 3600))
+
+lens_name_memo = TTLCache(LENS_NAME_MEMO_SIZE)
+
+LENS_BRANDS = {
+    "canon": "Canon", "кэнон": "Canon", "кенон": "Canon",
+    "nikon": "Nikon", "никон": "Nikon",
+    "sony": "Sony", "сони": "Sony",
+    "sigma": "Sigma", "сигма": "Sigma",
+    "tamron": "Tamron", "тамрон": "Tamron",
+    "zeiss": "Zeiss", "цейсс": "Zeiss", "цейс": "Zeiss",
+    "voigtlander": "Voigtlander", "фойхтлендер": "Voigtlander",
+    "samyang": "Samyang", "самъянг": "Samyang", "самьянг": "Samyang",
+    "tokina": "Tokina", "токина": "Tokina",
+    "pentax": "Pentax", "пентакс": "Pentax",
+    "fujifilm": "Fujifilm", "fuji": "Fujifilm", "фуджи": "Fujifilm",
+    "olympus": "Olympus", "олимпус": "Olympus",
+    "panasonic": "Panasonic", "панасоник": "Panasonic",
+    "leica": "Leica", "лейка": "Leica",
+    "viltrox": "Viltrox", "laowa": "Laowa", "7artisans": "7Artisans", "ttartisan": "TTArtisan",
+}
+
+SOVIET_LENSES = {
+    "гелиос": "Helios", "helios": "Helios",
+    "юпитер": "Jupiter", "jupiter": "Jupiter",
+    "индустар": "Industar", "industar": "Industar",
+    "зенитар": "Zenitar", "zenitar": "Zenitar",
+    "таир": "Tair", "tair": "Tair",
+    "мир": "Mir", "mir": "Mir",
+}
+
+LENS_SERIES = {
+    "stm": "STM", "usm": "USM", "is": "IS", "l": "L", "art": "Art", "contemporary": "Contemporary",
+    "sports": "Sports", "dg": "DG", "dc": "DC", "dn": "DN", "hsm": "HSM", "os": "OS",
+    "gm": "GM", "g": "G", "za": "ZA", "oss": "OSS", "vr": "VR", "af-s": "AF-S", "af-p": "AF-P",
+    "di": "Di", "vc": "VC", "usd": "USD", "rxd": "RXD", "xf": "XF", "xc": "XC", "wr": "WR",
+    "lm": "LM", "macro": "Macro", "pro": "PRO", "ii": "II", "iii": "III",
+}
+
+_brand_re = re.compile(
+    r"(?<![\w])(" + "|".join(sorted(map(re.escape, LENS_BRANDS), key=len, reverse=True)) + r")(?![\w])"
+)
+_soviet_re = re.compile(
+    r"(?<![\w])(" + "|".join(map(re.escape, SOVIET_LENSES)) + r")[\s-]*(\d{1,3}[a-zа-я]?(?:-\d{1,2}[a-zа-я]?)?)(?![\w-])"
+)
+_CYR_TO_LAT = str.maketrans("мнкав", "mnkab")
+_focal_re = re.compile(r"(?<![\w.-])(\d{1,3}(?:-\d{1,3})?)\s*(?:mm|мм)(?![\w])")
+_aperture_re = re.compile(r"(?<![\w])f\s*/?\s*(\d{1,2}(?:[.,]\d{1,2})?(?:-\d{1,2}(?:[.,]\d{1,2})?)?)(?![\w])")
+_series_re = re.compile(r"(?<![\w-])(" + "|".join(map(re.escape, LENS_SERIES)) + r")(?![\w-])")
+# Названия, совпадающие с обычными словами («весь мир 2 раза»): верим им только
+# через дефис («мир-1») или с заглавной («Мир 1В»)
+_soviet_common_words = {"мир"}
+
+
+def local_lens_name(text: str) -> str | None:
+    """Детерминированно вытаскивает модель из текста без LLM.
+
+    Возвращает None, если вариантов несколько или данных мало — тогда
+    решает LLM.
+    """
+    text_lower = text.lower()
+    # Регистр смотрим по исходному тексту; если lower() сдвинул позиции — считаем всё строчным
+    original = text if len(text) == len(text_lower) else text_lower
+    brands = {LENS_BRANDS[m] for m in _brand_re.findall(text_lower)}
+    soviet = {
+        (SOVIET_LENSES[m[1]], m[2].translate(_CYR_TO_LAT).upper())
+        for m in _soviet_re.finditer(text_lower)
+        if m[1] not in _soviet_common_words or "-" in text_lower[m.end(1):m.start(2)] or original[m.start()].isupper()
+    }
+
+    if len(soviet) == 1 and not brands:
+        name, model = soviet.pop()
+        focal = set(_focal_re.findall(text_lower))
+        return f"{name} {model}" + (f" {focal.pop()}mm" if len(focal) == 1 else "")
+
+    if len(brands) != 1 or soviet:
+        return None
+    focal = set(_focal_re.findall(text_lower))
+    if len(focal) != 1:
+        return None
+
+    parts = [brands.pop(), f"{focal.pop()}mm"]
+    apertures = {a.replace(",", ".") for a in _aperture_re.findall(text_lower)}
+    if len(apertures) > 1:
+        return None
+    if apertures:
+        parts.append(f"f{apertures.pop()}")
+
+    # Серию берём только из хвоста после фокусного, чтобы не цеплять слова из вопроса.
+    # Короткие (is, l, g, di) — ещё и обычные слова: верим им в верхнем регистре
+    # или сразу за диафрагмой («f/1.2 l usm», но не «f/1.8 - is it good», «di is good»)
+    start = _focal_re.search(text_lower).end()
+    aperture = _aperture_re.search(text_lower, start)
+    for m in _series_re.finditer(text_lower, start, start + 40):
+        after_aperture = aperture is not None and not text_lower[aperture.end():m.start()].strip()
+        if len(m[1]) <= 2 and not after_aperture and not original[m.start():m.end()].isupper():
+            continue
+        if LENS_SERIES[m[1]] not in parts:
+            parts.append(LENS_SERIES[m[1]])
+    return " ".join(parts)
+
+
+async def llm_extract_lens_name(text: str) -> str | None:
+    response = await complete(
+        purpose="extract",
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "Из текста извлеки название конкретного объектива или камеры для поиска.\n"
+                    "Верни ТОЛЬКО краткое название модели, например: 'Helios 44-2 58mm', 'Canon 50mm f1.8 STM', 'Sigma 35mm Art'.\n"
+                    "Если конкретного объектива или камеры нет — верни: NONE\n"
+                    "Только название или NONE, без пояснений."
+                ),
+            },
+            {"role": "user", "content": text},
+        ],
+        max_tokens=30,
+        temperature=0,
+    )
+    result = response.choices[0].message.content.strip()
+    if result.upper() == "NONE" or not result:
         return None
+    return result
+
+
+async def extract_lens_name(text: str) -> str | None:
+    key = " ".join(text.lower().split())
+    cached = lens_name_memo.get(key, _MISSING)
+    if cached is not _MISSING:
+        metrics.inc("lensbot_lens_name_total", source="memo")
+        logger.info(f"Название из памяти: '{cached}'")
+        return cached
+
+    result = local_lens_name(text)
+    if result:
+        metrics.inc("lensbot_lens_name_total", source="local")
+        logger.info(f"Извлечено локально: '{result}'")
+    else:
+        metrics.inc("lensbot_lens_name_total", source="llm")
+        try:
+            result = await llm_extract_lens_name(text)
+        except Shed:
+            return None
+        except Exception as e:
+            metrics.inc("lensbot_errors_total", source="deepseek")
+            logger.warning(f"extract_lens_name error: {e}")
+            return None
+        if result:
+            logger.info(f"Извлечено название: '{result}'")
+
+    lens_name_memo.set(key, result, LENS_NAME_MEMO_TTL)
+    return result
 
 
 # ─── DuckDuckGo поиск URL ─────────────────────────────────────────────────────
 
-def ddg_find_url(query: str, site: str) -> str | None:
+async def ddg_find_url(query: str, site: str) -> str | None:
     """Находит первый подходящий URL на сайте через DuckDuckGo."""
     try:
         ddg_url = "https://html.duckduckgo.com/html/"
         params = {"q": f"site:{site} {query}", "kl": "ru-ru"}
-        r = httpx.post(ddg_url, data=params, headers=HEADERS, timeout=10, follow_redirects=True)
+        r = await http_request("POST", ddg_url, data=params)
         soup = BeautifulSoup(r.text, "html.parser")
 
         for a in soup.select(".result__title a"):
@@ -180,180 +1470,883 @@ def ddg_find_url(query: str, site: str) -> str | None:
                     return url
         return None
     except Exception as e:
+        # Сбой — не «ничего не нашли»: пусть решает fetch_lens_data
+        metrics.inc("lensbot_errors_total", source="duckduckgo")
         logger.warning(f"ddg_find_url error ({site}): {e}")
-        return None
+        raise
+
+
+# ─── Разбор HTML ─────────────────────────────────────────────────────────────
+
+# lxml заметно быстрее встроенного html.parser, но кривую разметку (<div> внутри <p>,
+# незакрытый <p> перед <table>) чинит иначе, и выдержки со страниц получаются другими.
+# Поэтому только по явному HTML_PARSER=lxml; расхождения показывает bench.py parsers
+HTML_PARSER = os.environ.get("HTML_PARSER", "html.parser")
+
+SPECS_LIMIT = 10
+CONTENT_LIMIT = 1200
+
+_article_class_re = re.compile(r"review|content|text|body", re.I)
+
+
+def _attrs_class(attrs) -> str:
+    if isinstance(attrs, dict):
+        value = attrs.get("class", "")
+    else:
+        value = next((v for k, v in attrs if k == "class"), "")
+    return " ".join(value) if isinstance(value, list) else (value or "")
+
+
+def _photozone_tags(name, attrs=None) -> bool:
+    return name in ("h1", "title", "table", "p")
+
+
+def _prophotos_tags(name, attrs=None) -> bool:
+    if name in ("h1", "title", "table", "dl", "article", "p"):
+        return True
+    return name == "div" and attrs is not None and bool(_article_class_re.search(_attrs_class(attrs)))
+
+
+PHOTOZONE_STRAINER = SoupStrainer(_photozone_tags)
+PROPHOTOS_STRAINER = SoupStrainer(_prophotos_tags)
+
+
+def parse_html(html: str, strainer: SoupStrainer) -> BeautifulSoup:
+    """Строит дерево только из нужных тегов: заголовки, таблицы, текст статьи."""
+    return BeautifulSoup(html, HTML_PARSER, parse_only=strainer)
+
+
+def collect_specs(rows, cell_names: list[str], exact: bool, val_limit: int) -> list[str]:
+    specs = []
+    for row in rows:
+        cells = row.find_all(cell_names)
+        if (len(cells) == 2) if exact else (len(cells) >= 2):
+            key = cells[0].get_text(strip=True)
+            val = cells[1].get_text(strip=True)
+            if key and val and len(key) < 60 and len(val) < val_limit:
+                specs.append(f"{key}: {val}")
+                if len(specs) == SPECS_LIMIT:
+                    break
+    return specs
+
+
+def collect_content(paragraphs, min_len: int, stop_words: tuple[str, ...]) -> str:
+    """Склеивает абзацы до CONTENT_LIMIT символов, дальше не читает."""
+    content = []
+    total = -1
+    for p in paragraphs:
+        text = p.get_text(strip=True)
+        if len(text) <= min_len or "©" in text:
+            continue
+        text_lower = text.lower()
+        if any(w in text_lower for w in stop_words):
+            continue
+        content.append(text)
+        total += len(text) + 1
+        if total >= CONTENT_LIMIT:
+            break
+    return " ".join(content)[:CONTENT_LIMIT]
 
 
 # ─── Парсер photozone.de ──────────────────────────────────────────────────────
 
-def parse_photozone(url: str) -> str | None:
+async def parse_photozone(url: str) -> str | None:
     try:
-        r = httpx.get(url, headers=HEADERS, timeout=10, follow_redirects=True)
-        soup = BeautifulSoup(r.text, "html.parser")
+        r = await http_request("GET", url)
+        return await cpu_pool.run("parse", extract_photozone, r.text, url)
+    except Exception as e:
+        metrics.inc("lensbot_errors_total", source="photozone.de")
+        logger.warning(f"parse_photozone error: {e}")
+        raise
+
+
+def extract_photozone(html: str, url: str) -> str | None:
+    soup = parse_html(html, PHOTOZONE_STRAINER)
 
-        parts = []
-
-        title = soup.find("h1") or soup.find("title")
-        if title:
-            parts.append(f"[photozone.de] {title.get_text(strip=True)}")
-
-        # Характеристики из таблицы
-        specs = []
-        for row in soup.select("table tr"):
-            cells = row.find_all(["td", "th"])
-            if len(cells) == 2:
-                key = cells[0].get_text(strip=True)
-                val = cells[1].get_text(strip=True)
-                if key and val and len(key) < 60 and len(val) < 100:
-                    specs.append(f"{key}: {val}")
-        if specs:
-            parts.append("Характеристики: " + " | ".join(specs[:10]))
-
-        # Текст статьи
-        content = []
-        for p in soup.find_all("p"):
-            text = p.get_text(strip=True)
-            if (len(text) > 50
-                    and "©" not in text
-                    and "cookie" not in text.lower()
-                    and "affiliate" not in text.lower()):
-                content.append(text)
-
-        if content:
-            parts.append(" ".join(content)[:1200])
-
-        parts.append(f"Ссылка: {url}")
-
-        return "\n\n".join(parts) if len(parts) > 1 else None
+    parts = []
 
+    title = soup.find("h1") or soup.find("title")
+    if title:
+        parts.append(f"[photozone.de] {title.get_text(strip=True)}")
+
+    # Характеристики из таблицы
+    specs = collect_specs(soup.select("table tr"), ["td", "th"], exact=True, val_limit=100)
+    if specs:
+        parts.append("Характеристики: " + " | ".join(specs))
+
+    # Текст статьи
+    content = collect_content(soup.find_all("p"), 50, ("cookie", "affiliate"))
+    if content:
+        parts.append(content)
+
+    parts.append(f"Ссылка: {url}")
+
+    return "\n\n".join(parts) if len(parts) > 1 else None
+
+
+# ─── Парсер prophotos.ru ──────────────────────────────────────────────────────
+
+async def parse_prophotos(url: str) -> str | None:
+    try:
+        r = await http_request("GET", url)
+        return await cpu_pool.run("parse", extract_prophotos, r.text, url)
     except Exception as e:
-        logger.warning(f"parse_photozone error: {e}")
+        metrics.inc("lensbot_errors_total", source="prophotos.ru")
+        logger.warning(f"parse_prophotos error: {e}")
+        raise
+
+
+def extract_prophotos(html: str, url: str) -> str | None:
+    soup = parse_html(html, PROPHOTOS_STRAINER)
+
+    parts = []
+
+    title = soup.find("h1") or soup.find("title")
+    if title:
+        parts.append(f"[prophotos.ru] {title.get_text(strip=True)}")
+
+    # Характеристики — таблицы или dl/dt
+    specs = collect_specs(soup.select("table tr, dl"), ["td", "th", "dt", "dd"], exact=False, val_limit=150)
+    if specs:
+        parts.append("Характеристики: " + " | ".join(specs))
+
+    # Основной текст — ищем article или div с текстом
+    article = soup.find("article") or soup.find("div", class_=_article_class_re)
+    paragraphs = article.find_all("p") if article else soup.find_all("p")
+
+    content = collect_content(paragraphs, 60, ("cookie", "подпишит", "реклам"))
+    if content:
+        parts.append(content)
+
+    parts.append(f"Ссылка: {url}")
+
+    return "\n\n".join(parts) if len(parts) > 1 else None
+
+
+# ─── Локальный индекс объективов ─────────────────────────────────────────────
+
+LENS_INDEX_PATH = os.environ.get("LENS_INDEX_PATH", "lens_index.sqlite3")
+
+PARSERS = {
+    "photozone.de": extract_photozone,
+    "prophotos.ru": extract_prophotos,
+}
+
+_canonical_words = {alias: name.lower() for alias, name in {**LENS_BRANDS, **SOVIET_LENSES}.items()}
+_aperture_token_re = re.compile(r"^f\d")
+
+
+def canonical_lens_name(name: str) -> str:
+    """Нормализованное название с брендами и советскими стёклами в латинице."""
+    return " ".join(_canonical_words.get(w, w) for w in normalize_lens_name(name).split())
+
+
+def lens_aliases(name: str) -> list[str]:
+    """Варианты названия для индекса: как есть, в латинице и короткая модель."""
+    aliases = [normalize_lens_name(name), canonical_lens_name(name)]
+    extracted = local_lens_name(name)
+    if extracted:
+        aliases.append(normalize_lens_name(extracted))
+    return list(dict.fromkeys(aliases))
+
+
+class LensIndex:
+    """Полнотекстовый индекс (SQLite FTS5) по заранее распарсенным обзорам."""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS lenses USING fts5("
+            "aliases, site UNINDEXED, url UNINDEXED, data UNINDEXED, "
+            "tokenize = \"unicode61 tokenchars '.-'\")"
+        )
+        self.db.commit()
+
+    def add(self, site: str, url: str, data: str) -> None:
+        title = data.split("\n", 1)[0].removeprefix(f"[{site}]").strip()
+        self.db.execute("DELETE FROM lenses WHERE url = ?", (url,))
+        self.db.execute(
+            "INSERT INTO lenses (aliases, site, url, data) VALUES (?, ?, ?, ?)",
+            (" | ".join(lens_aliases(title)), site, url, data),
+        )
+        self.db.commit()
+
+    def lookup(self, lens_name: str) -> str | None:
+        """Лучшее совпадение по каждому сайту в формате fetch_lens_data."""
+        tokens = canonical_lens_name(lens_name).split()
+        # Сначала все слова, потом без диафрагмы — она в заголовках часто опущена.
+        # Фокусное обязательно: без него 50mm находит 24mm или 85mm той же серии
+        for query_tokens in (tokens, [t for t in tokens if not _aperture_token_re.match(t)]):
+            # По одному бренду не угадать конкретное стекло
+            if len(query_tokens) < 2:
+                continue
+            query = " ".join('"' + t.replace('"', "") + '"' for t in query_tokens)
+            rows = self.db.execute(
+                "SELECT site, data FROM lenses WHERE lenses MATCH ? ORDER BY rank", (f"aliases : ({query})",)
+            ).fetchall()
+            best = {}
+            for site, data in rows:
+                best.setdefault(site, data)
+            if best:
+                return "\n\n---\n\n".join(best.values())
         return None
 
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM lenses").fetchone()[0]
 
-# ─── Парсер prophotos.ru ──────────────────────────────────────────────────────
 
-def parse_prophotos(url: str) -> str | None:
+def open_lens_index(path: str) -> LensIndex | None:
+    if not path:
+        return None
     try:
-        r = httpx.get(url, headers=HEADERS, timeout=10, follow_redirects=True)
-        soup = BeautifulSoup(r.text, "html.parser")
+        return LensIndex(path)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Индекс объективов недоступен: {e}")
+        return None
 
-        parts = []
-
-        title = soup.find("h1") or soup.find("title")
-        if title:
-            parts.append(f"[prophotos.ru] {title.get_text(strip=True)}")
-
-        # Характеристики — таблицы или dl/dt
-        specs = []
-        for row in soup.select("table tr, dl"):
-            cells = row.find_all(["td", "th", "dt", "dd"])
-            if len(cells) >= 2:
-                key = cells[0].get_text(strip=True)
-                val = cells[1].get_text(strip=True)
-                if key and val and len(key) < 60 and len(val) < 150:
-                    specs.append(f"{key}: {val}")
-        if specs:
-            parts.append("Характеристики: " + " | ".join(specs[:10]))
-
-        # Основной текст — ищем article или div с текстом
-        article = soup.find("article") or soup.find("div", class_=re.compile(r"review|content|text|body", re.I))
-        if article:
-            paragraphs = article.find_all("p")
+
+lens_index = open_lens_index(LENS_INDEX_PATH)
+
+
+def site_of(url: str) -> str | None:
+    host = httpx.URL(url).host.removeprefix("www.")
+    return host if host in PARSERS else None
+
+
+async def ingest_sources(sources: list[str], site: str | None = None) -> int:
+    """Прогоняет парсеры по URL, сохранённым HTML-файлам и спискам URL (.txt)."""
+    items = []
+    for source in sources:
+        if source.endswith(".txt"):
+            with open(source, encoding="utf-8") as f:
+                items.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
         else:
-            paragraphs = soup.find_all("p")
+            items.append(source)
 
-        content = []
-        for p in paragraphs:
-            text = p.get_text(strip=True)
-            if (len(text) > 60
-                    and "©" not in text
-                    and "cookie" not in text.lower()
-                    and "подпишит" not in text.lower()
-                    and "реклам" not in text.lower()):
-                content.append(text)
+    added = 0
+    for item in items:
+        try:
+            if item.startswith(("http://", "https://")):
+                url = item
+                html = (await http_request("GET", url)).text
+            else:
+                with open(item, encoding="utf-8", errors="replace") as f:
+                    html = f.read()
+                match = re.search(r'<link[^>]+rel="canonical"[^>]+href="([^"]+)"', html) or \
+                    re.search(r'<meta[^>]+property="og:url"[^>]+content="([^"]+)"', html)
+                url = match.group(1) if match else f"file://{os.path.abspath(item)}"
+            item_site = site_of(url) or site
+            if item_site is None:
+                logger.warning(f"ingest: не понять сайт для {item}, укажи --site")
+                continue
+            data = PARSERS[item_site](html, url)
+            if data:
+                lens_index.add(item_site, url, data)
+                added += 1
+                logger.info(f"ingest: {item_site} {url}")
+            else:
+                logger.info(f"ingest: пусто {item}")
+        except Exception as e:
+            logger.warning(f"ingest error ({item}): {e}")
+    return added
 
-        if content:
-            parts.append(" ".join(content)[:1200])
 
-        parts.append(f"Ссылка: {url}")
+def ingest_main(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(prog="main.py ingest", description="Наполнение локального индекса объективов")
+    parser.add_argument("sources", nargs="+", help="URL, сохранённые HTML или .txt со списком URL")
+    parser.add_argument("--site", choices=sorted(PARSERS), help="сайт для HTML без canonical-ссылки")
+    args = parser.parse_args(argv)
+    if lens_index is None:
+        raise SystemExit("LENS_INDEX_PATH не задан или FTS5 недоступен")
 
-        return "\n\n".join(parts) if len(parts) > 1 else None
+    async def run():
+        try:
+            return await ingest_sources(args.sources, args.site)
+        finally:
+            await http_client.aclose()
 
-    except Exception as e:
-        logger.warning(f"parse_prophotos error: {e}")
-        return None
+    added = asyncio.run(run())
+    logger.info(f"ingest: добавлено {added}, всего в индексе {len(lens_index)}")
 
 
 # ─── Поиск с обоих сайтов параллельно ────────────────────────────────────────
 
-def fetch_lens_data(lens_name: str) -> str | None:
-    """Ищет на photozone.de и prophotos.ru параллельно, объединяет результаты."""
+class LensSearchIncomplete(Exception):
+    """Ничего не нашли, но источник упал или не уложился в дедлайн — кэшировать нельзя."""
 
-    def search_photozone():
-        url = ddg_find_url(f"{lens_name} review", "photozone.de")
+
+async def fetch_lens_data(lens_name: str) -> str | None:
+    """Ищет на photozone.de и prophotos.ru параллельно, объединяет результаты.
+
+    Сначала смотрит в локальный индекс, в сеть идёт только при промахе.
+    None — оба сайта честно ответили, что обзора нет. Если данных нет,
+    а какой-то сайт упал или не успел, бросает LensSearchIncomplete.
+    """
+    if lens_index is not None:
+        indexed = lens_index.lookup(lens_name)
+        if indexed:
+            logger.info(f"Индекс объективов: найдено '{lens_name}'")
+            return indexed
+
+    async def search_photozone():
+        with metrics.stage("ddg_search", site="photozone.de"):
+            url = await ddg_find_url(f"{lens_name} review", "photozone.de")
         if url:
             logger.info(f"photozone URL: {url}")
-            return parse_photozone(url)
+            with metrics.stage("scrape", site="photozone.de"):
+                return await parse_photozone(url)
         return None
 
-    def search_prophotos():
-        url = ddg_find_url(f"{lens_name} обзор тест объектив", "prophotos.ru")
+    async def search_prophotos():
+        with metrics.stage("ddg_search", site="prophotos.ru"):
+            url = await ddg_find_url(f"{lens_name} обзор тест объектив", "prophotos.ru")
         if url:
             logger.info(f"prophotos URL: {url}")
-            return parse_prophotos(url)
+            with metrics.stage("scrape", site="prophotos.ru"):
+                return await parse_prophotos(url)
         return None
 
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FETCH_DEADLINE
+    token = fetch_deadline.set(deadline)
+    tasks = {
+        asyncio.create_task(search_photozone()): "photozone",
+        asyncio.create_task(search_prophotos()): "prophotos",
+    }
+    fetch_deadline.reset(token)
+    pending = set(tasks)
     results = []
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        futures = {
-            executor.submit(search_photozone): "photozone",
-            executor.submit(search_prophotos): "prophotos",
-        }
-        for future in as_completed(futures):
-            site = futures[future]
+    failed = []
+
+    # Ждём до общего дедлайна; после первого удачного ответа — не дольше FETCH_GRACE
+    while pending:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            site = tasks[task]
             try:
-                data = future.result()
+                data = task.result()
                 if data:
                     results.append(data)
                     logger.info(f"{site}: данные получены ({len(data)} символов)")
                 else:
                     logger.info(f"{site}: ничего не найдено")
             except Exception as e:
+                failed.append(site)
                 logger.warning(f"{site} error: {e}")
+        if results:
+            deadline = min(deadline, loop.time() + FETCH_GRACE)
+
+    for task in pending:
+        task.cancel()
+        failed.append(tasks[task])
+        logger.info(f"{tasks[task]}: не уложился в дедлайн, пропускаем")
 
     if results:
         return "\n\n---\n\n".join(results)
+    if failed:
+        raise LensSearchIncomplete(", ".join(failed))
     return None
 
 
+SEARCH_KEYWORDS = [
+    r"\d+\s*mm", r"\d+\s*мм", r"f/[\d.]+",
+    "объектив", "стекло", "линз",
+    "canon", "nikon", "sony", "sigma", "tamron", "zeiss", "цейсс",
+    "voigtlander", "samyang", "tokina", "pentax", "fuji",
+    "гелиос", "гелик", "юпитер", "индустар", "зенитар",
+    "характеристик", "резкость", "светосил",
+    "обзор", "стоит брать", "посоветуй стекло",
+    "байонет", "кроп-фактор", "автофокус",
+]
+
+search_matcher = PatternMatcher(SEARCH_KEYWORDS)
+
+
+def match_search(text: str) -> str | None:
+    """Ключевое слово из SEARCH_KEYWORDS, из-за которого нужен поиск, или None."""
+    return search_matcher.search(text.lower())
+
+
 def should_search(text: str) -> bool:
-    keywords = [
-        r"\d+\s*mm", r"\d+\s*мм", r"f/[\d.]+",
-        "объектив", "стекло", "линз",
-        "canon", "nikon", "sony", "sigma", "tamron", "zeiss", "цейсс",
-        "voigtlander", "samyang", "tokina", "pentax", "fuji",
-        "гелиос", "гелик", "юпитер", "индустар", "зенитар",
-        "характеристик", "резкость", "светосил",
-        "обзор", "стоит брать", "посоветуй стекло",
-        "байонет", "кроп-фактор", "автофокус",
-    ]
-    text_lower = text.lower()
-    return any(re.search(kw, text_lower) for kw in keywords)
+    return match_search(text) is not None
+
+
+# ─── Предфильтр проверки ошибок ──────────────────────────────────────────────
+
+# Что-то из этого должно быть в сообщении, чтобы имело смысл звать MISTAKE_PROMPT
+TECH_PATTERNS = [
+    r"\d+(?:[.,]\d+)?\s*(?:mm|мм)(?![\w])",
+    r"(?<![\w])f\s*/?\s*\d+(?:[.,]\d+)?",
+    r"(?<![\w])(?:iso|исо)\s*\d+",
+    r"(?<![\w])1/\d{2,5}(?![\w])",
+    r"(?<![\w])\d+(?:[.,]\d+)?\s*(?:x|х)(?![\w])",
+    r"\d+(?:[.,]\d+)?\s*(?:мп|mp|мегапикс|стоп|ev)",
+    r"кроп|crop|полный кадр|полнокадр|full.?frame|(?<![\w])фф(?![\w])|матриц|сенсор|sensor",
+    r"диафрагм|выдержк|экспозиц|(?<![\w])грип|фокусн|светосил|aperture|shutter|focal|exposure",
+    r"байонет|переходник|адаптер|(?<![\w])(?:ef-?[sm]?|rf-?s?|fe|m42|m39|mft|m4/3)(?![\w])"
+    r"|(?:e|z|f|x|k|l)-mount|микр[аоуые](?![\w])",
+    r"стабилиз|автофокус|дисторс|виньет|аберрац|боке|резкост|разрешени|перспектив",
+    r"объектив|телевик|ширик|полтинник|(?<![\w])(?:фикс|зум|стекл[оаеу]|lens|zoom)(?![\w])",
+    _brand_re.pattern,
+    _soviet_re.pattern,
+]
+
+tech_matcher = PatternMatcher(TECH_PATTERNS)
+
+# filter — только сообщения с техническими утверждениями, all — все, off — никакие
+MISTAKE_CHECK_DEFAULT = os.environ.get("MISTAKE_CHECK_DEFAULT", "filter")
+# Переопределения по чатам: "-100123:all,-100456:off"
+MISTAKE_CHECK_CHATS = {
+    int(chat): mode
+    for chat, mode in (
+        item.strip().split(":", 1)
+        for item in os.environ.get("MISTAKE_CHECK_CHATS", "").split(",")
+        if item.strip()
+    )
+}
+
+mistake_stats: Counter = Counter()
+
+
+def looks_technical(text: str) -> str | None:
+    """Правило из TECH_PATTERNS, по которому сообщение похоже на техническое утверждение."""
+    return tech_matcher.search(text.lower())
+
+
+async def should_check_mistakes(chat_id: int, text: str) -> bool:
+    mode = MISTAKE_CHECK_CHATS.get(chat_id, MISTAKE_CHECK_DEFAULT)
+    if mode == "off":
+        send = False
+    elif mode == "all":
+        send = True
+    else:
+        send = await cpu_pool.run("regex", looks_technical, text) is not None
+    mistake_stats["sent" if send else "skipped"] += 1
+    return send
+
+
+# ─── Пакетная проверка ошибок ────────────────────────────────────────────────
+
+# Сколько секунд копить сообщения чата и сколько максимум слать за раз
+MISTAKE_BATCH_WINDOW = float(os.environ.get("MISTAKE_BATCH_WINDOW", 5))
+MISTAKE_BATCH_SIZE = int(os.environ.get("MISTAKE_BATCH_SIZE", 10))
+
+_batch_line_re = re.compile(r"^\s*(\d+)\s*[:.)]\s*(.+)$")
+
+
+async def check_mistakes(batch: list[tuple[str, Message]]) -> None:
+    """Один запрос к модели на пачку сообщений, поправки — ответом на исходные."""
+    if len(batch) == 1:
+        messages = [
+            {"role": "system", "content": MISTAKE_PROMPT},
+            {"role": "user", "content": batch[0][1].text},
+        ]
+        max_tokens = 150
+    else:
+        numbered = "\n".join(f"{i}. {name}: {m.text}" for i, (name, m) in enumerate(batch, 1))
+        messages = [
+            {"role": "system", "content": MISTAKE_BATCH_PROMPT},
+            {"role": "user", "content": numbered},
+        ]
+        max_tokens = 150 * min(len(batch), 3)
+
+    # Квота чата, а не авторов: пачка общая
+    llm_caller.set((None, batch[0][1].chat_id))
+    try:
+        response = await complete(purpose="mistake", messages=messages, max_tokens=max_tokens, temperature=0.1)
+        answer = response.choices[0].message.content.strip()
+    except Shed as e:
+        logger.info(f"Mistake check пропущен: {e}")
+        return
+    except Exception as e:
+        metrics.inc("lensbot_errors_total", source="deepseek")
+        logger.error(f"Mistake check error: {e}")
+        return
+
+    logger.info(f"Mistake check ({len(batch)} сообщ.): {answer[:100]} ({dict(mistake_stats)})")
+    if answer.upper() == "SKIP":
+        return
+
+    if len(batch) == 1:
+        corrections = [(batch[0][1], answer)]
+    else:
+        corrections = []
+        for line in answer.splitlines():
+            match = _batch_line_re.match(line)
+            if match and 1 <= int(match.group(1)) <= len(batch) and match.group(2).upper() != "SKIP":
+                corrections.append((batch[int(match.group(1)) - 1][1], match.group(2).strip()))
+
+    for message, correction in corrections:
+        try:
+            await message.reply_text(correction)
+        except Exception as e:
+            metrics.inc("lensbot_errors_total", source="telegram")
+            logger.error(f"Mistake reply error: {e}")
+
+
+class MistakeBatcher:
+    """Копит сообщения чата до окна или лимита и проверяет их одним запросом."""
+
+    def __init__(self, window: float, size: int):
+        self.window = window
+        self.size = size
+        self._pending: dict[int, list[tuple[str, Message]]] = {}
+        self._timers: dict[int, asyncio.Task] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def add(self, chat_id: int, user_name: str, message: Message) -> None:
+        batch = self._pending.setdefault(chat_id, [])
+        batch.append((user_name, message))
+        if len(batch) >= self.size:
+            timer = self._timers.pop(chat_id, None)
+            if timer:
+                timer.cancel()
+            self._spawn(check_mistakes(self._pending.pop(chat_id)))
+        elif chat_id not in self._timers:
+            self._timers[chat_id] = self._spawn(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id: int) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(chat_id, None)
+        await self.flush(chat_id)
+
+    async def flush(self, chat_id: int) -> None:
+        batch = self._pending.pop(chat_id, None)
+        if batch:
+            await check_mistakes(batch)
+
+    async def flush_all(self) -> None:
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        await asyncio.gather(*(self.flush(chat_id) for chat_id in list(self._pending)))
+
+    def _spawn(self, coro) -> asyncio.Task:
+        # Фоновая проверка не относится к трассе апдейта, который её запустил
+        task = asyncio.create_task(coro, context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+
+mistake_batcher = MistakeBatcher(MISTAKE_BATCH_WINDOW, MISTAKE_BATCH_SIZE)
 
 
 # ─── История ─────────────────────────────────────────────────────────────────
 
-def get_private_history(user_id: int) -> deque:
-    if user_id not in private_histories:
-        private_histories[user_id] = deque(maxlen=MAX_HISTORY)
-    return private_histories[user_id]
+# memory — только в памяти процесса, sqlite — с записью на диск пачками,
+# shared — пачками в общее состояние воркеров (STATE_BACKEND)
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "memory")
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", "histories.sqlite3")
+HISTORY_MAX_CHATS = int(os.environ.get("HISTORY_MAX_CHATS", 20000))
+# Историю чата, в котором давно не писали, выкидываем из памяти
+HISTORY_IDLE_TTL = int(os.environ.get("HISTORY_IDLE_TTL", 7 * 24 * 3600))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 5))
+# Сколько последних сообщений группы идут в запрос как есть
+GROUP_RAW_LINES = int(os.environ.get("GROUP_RAW_LINES", 12))
+# Длинные сообщения в контексте обрезаются до стольких символов
+GROUP_LINE_CHARS = int(os.environ.get("GROUP_LINE_CHARS", 300))
+# Сводка обновляется, когда из окна выпало столько сообщений
+GROUP_SUMMARY_BATCH = int(os.environ.get("GROUP_SUMMARY_BATCH", 10))
+# ...но только в группах, где бота звали не раньше стольких секунд назад
+GROUP_SUMMARY_ACTIVE_TTL = int(os.environ.get("GROUP_SUMMARY_ACTIVE_TTL", 3600))
+GROUP_SUMMARY_TOKENS = int(os.environ.get("GROUP_SUMMARY_TOKENS", 200))
+# Потолок на сводку и переписку в запросе по упоминанию; старые строки выпадают первыми
+GROUP_CONTEXT_TOKENS = int(os.environ.get("GROUP_CONTEXT_TOKENS", 1200))
+
+
+class Turn:
+    """Реплика приватного диалога."""
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+
+    def as_message(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+    def as_row(self) -> list:
+        return [self.role, self.content]
+
+
+class GroupLine:
+    """Сообщение из группового чата."""
+    __slots__ = ("name", "text")
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+
+    def as_row(self) -> list:
+        return [self.name, self.text]
+
+
+class History(deque):
+    """deque с maxlen, который сообщает хранилищу об изменениях и о выпавших записях."""
+    __slots__ = ("key", "store", "touched")
+
+    def append(self, item) -> None:
+        if len(self) == self.maxlen and self.store.on_retire is not None:
+            self.store.on_retire(self.key, self[0])
+        super().append(item)
+        self.store.mark_dirty(self.key)
+
+
+class MemoryHistoryStore:
+    """Истории чатов в памяти: LRU по числу чатов плюс выброс по простою."""
+
+    def __init__(self, entry_type, max_chats: int, idle_ttl: float, maxlen: int = MAX_HISTORY):
+        self.entry_type = entry_type
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self.maxlen = maxlen
+        # Вызывается с (key, запись), когда запись выпадает из полной истории
+        self.on_retire = None
+        # Вызывается с key, когда чат выброшен из памяти по LRU или простою
+        self.on_evict = None
+        self._items: OrderedDict[int, History] = OrderedDict()
+
+    def get(self, key: int) -> History:
+        now = time.time()
+        history = self._items.get(key)
+        if history is None:
+            history = self._new(key, self.load(key))
+            self._items[key] = history
+        history.touched = now
+        self._items.move_to_end(key)
+        self._evict(now)
+        return history
+
+    async def open(self, key: int) -> History:
+        return self.get(key)
+
+    def drop(self, key: int) -> None:
+        self._items.pop(key, None)
+
+    def mark_dirty(self, key: int) -> None:
+        pass
 
+    def load(self, key: int) -> list:
+        return []
+
+    def _new(self, key: int, entries: list) -> History:
+        history = History(entries, self.maxlen)
+        history.key = key
+        history.store = self
+        history.touched = time.time()
+        return history
+
+    def _evict(self, now: float) -> None:
+        while len(self._items) > self.max_chats:
+            self._evicted_chat(*self._items.popitem(last=False))
+        while self._items:
+            key, history = next(iter(self._items.items()))
+            if history.touched >= now - self.idle_ttl:
+                break
+            del self._items[key]
+            self._evicted_chat(key, history)
+
+    def _evicted_chat(self, key: int, history: History) -> None:
+        self._on_evict(key, history)
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def _on_evict(self, key: int, history: History) -> None:
+        pass
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SqliteHistoryStore(MemoryHistoryStore):
+    """То же плюс SQLite: изменения копятся и пишутся пачкой раз в HISTORY_FLUSH_INTERVAL.
+
+    Запросы идут в потоке SqliteFile; сброс истории (/reset) тоже
+    доезжает до файла со следующей пачкой.
+    """
+
+    def __init__(self, entry_type, max_chats: int, idle_ttl: float, maxlen: int, file: SqliteFile, kind: str):
+        super().__init__(entry_type, max_chats, idle_ttl, maxlen)
+        self.file = file
+        self.kind = kind
+        self._dirty: set[int] = set()
+        self._evicted: dict[int, History] = {}
+        self._dropped: set[int] = set()
+        self._loaded: dict[int, list] = {}
+        self.file.db.execute(
+            "CREATE TABLE IF NOT EXISTS histories ("
+            "kind TEXT NOT NULL, key INTEGER NOT NULL, entries TEXT NOT NULL, touched REAL NOT NULL, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self.file.db.commit()
+
+    def _read(self, key: int):
+        return self.file.db.execute(
+            "SELECT entries FROM histories WHERE kind = ? AND key = ?", (self.kind, key)
+        ).fetchone()
+
+    def _write(self, rows: list[tuple], dropped: list[tuple]) -> None:
+        if dropped:
+            self.file.db.executemany("DELETE FROM histories WHERE kind = ? AND key = ?", dropped)
+        if rows:
+            self.file.db.executemany(
+                "INSERT OR REPLACE INTO histories (kind, key, entries, touched) VALUES (?, ?, ?, ?)", rows
+            )
+        self.file.db.commit()
 
-def get_group_history(chat_id: int) -> deque:
-    if chat_id not in group_histories:
-        group_histories[chat_id] = deque(maxlen=MAX_HISTORY)
-    return group_histories[chat_id]
+    async def open(self, key: int) -> History:
+        if key not in self._items and key not in self._evicted and key not in self._dropped:
+            try:
+                row = await self.file.run(self._read, key)
+            except sqlite3.Error as e:
+                # Лучше ответить без истории, чем не ответить вовсе
+                logger.warning(f"История {self.kind}:{key}: ошибка чтения: {e}")
+                row = None
+            self._loaded[key] = [self.entry_type(*item) for item in json.loads(row[0])] if row else []
+        return self.get(key)
+
+    def load(self, key: int) -> list:
+        if key in self._evicted:
+            return list(self._evicted.pop(key))
+        return self._loaded.pop(key, [])
+
+    def drop(self, key: int) -> None:
+        super().drop(key)
+        self._dirty.discard(key)
+        self._evicted.pop(key, None)
+        self._dropped.add(key)
+
+    def mark_dirty(self, key: int) -> None:
+        self._dirty.add(key)
+
+    def _on_evict(self, key: int, history: History) -> None:
+        if key in self._dirty:
+            self._evicted[key] = history
+
+    async def flush(self) -> int:
+        dirty, self._dirty = self._dirty, set()
+        evicted, self._evicted = self._evicted, {}
+        dropped, self._dropped = self._dropped - dirty, set()
+        rows = []
+        for key in dirty:
+            history = self._items.get(key) or evicted.get(key)
+            if history is not None:
+                entries = json.dumps([e.as_row() for e in history], ensure_ascii=False)
+                rows.append((self.kind, key, entries, history.touched))
+        if rows or dropped:
+            try:
+                await self.file.run(self._write, rows, [(self.kind, key) for key in dropped])
+            except sqlite3.Error:
+                # Файл занят — запишем со следующей пачкой
+                self._dirty |= dirty
+                self._evicted = {**evicted, **self._evicted}
+                self._dropped |= dropped
+                raise
+        return len(rows)
+
+
+class SharedHistoryStore(MemoryHistoryStore):
+    """Истории в общем состоянии воркеров, пишутся пачками раз в HISTORY_FLUSH_INTERVAL.
+
+    Чат всегда ведёт один воркер, так что копия в памяти не устаревает;
+    общее состояние нужно, чтобы история пережила перезапуск воркеров.
+    """
+
+    def __init__(self, entry_type, max_chats: int, idle_ttl: float, maxlen: int, shared, kind: str):
+        super().__init__(entry_type, max_chats, idle_ttl, maxlen)
+        self.shared = shared
+        self.kind = kind
+        self._dirty: set[int] = set()
+        self._evicted: dict[int, History] = {}
+        self._dropped: set[int] = set()
+        self._loaded: dict[int, list] = {}
+
+    def _key(self, key: int) -> str:
+        return f"history:{self.kind}:{key}"
+
+    async def open(self, key: int) -> History:
+        if key not in self._items and key not in self._evicted and key not in self._dropped:
+            raw = await self.shared.get(self._key(key))
+            self._loaded[key] = [self.entry_type(*item) for item in json.loads(raw)] if raw else []
+        return self.get(key)
+
+    def load(self, key: int) -> list:
+        if key in self._evicted:
+            return list(self._evicted.pop(key))
+        return self._loaded.pop(key, [])
+
+    def drop(self, key: int) -> None:
+        super().drop(key)
+        self._dirty.discard(key)
+        self._evicted.pop(key, None)
+        self._dropped.add(key)
+
+    def mark_dirty(self, key: int) -> None:
+        self._dirty.add(key)
+
+    def _on_evict(self, key: int, history: History) -> None:
+        if key in self._dirty:
+            self._evicted[key] = history
+
+    async def flush(self) -> int:
+        dirty, self._dirty = self._dirty, set()
+        evicted, self._evicted = self._evicted, {}
+        for key in list(self._dropped):
+            if key not in dirty:
+                await self.shared.delete(self._key(key))
+            self._dropped.discard(key)
+        written = 0
+        for key in dirty:
+            history = self._items.get(key) or evicted.get(key)
+            if history is not None:
+                entries = json.dumps([e.as_row() for e in history], ensure_ascii=False)
+                await self.shared.set(self._key(key), entries, self.idle_ttl)
+                written += 1
+        return written
+
+
+def make_history_store(entry_type, kind: str, maxlen: int) -> MemoryHistoryStore:
+    if HISTORY_BACKEND == "shared":
+        return SharedHistoryStore(entry_type, HISTORY_MAX_CHATS, HISTORY_IDLE_TTL, maxlen, state, kind)
+    if HISTORY_BACKEND == "sqlite":
+        return SqliteHistoryStore(entry_type, HISTORY_MAX_CHATS, HISTORY_IDLE_TTL, maxlen, _history_file, kind)
+    return MemoryHistoryStore(entry_type, HISTORY_MAX_CHATS, HISTORY_IDLE_TTL, maxlen)
+
+
+_history_file = SqliteFile(HISTORY_DB_PATH, "history") if HISTORY_BACKEND == "sqlite" else None
+private_store = make_history_store(Turn, "private", MAX_HISTORY)
+# В группе храним только окно свежих сообщений, остальное уходит в сводку
+group_store = make_history_store(GroupLine, "group", GROUP_RAW_LINES)
+
+
+async def flush_histories() -> None:
+    for store in (private_store, group_store):
+        if not isinstance(store, (SharedHistoryStore, SqliteHistoryStore)):
+            continue
+        written = await store.flush()
+        if written:
+            logger.debug(f"История: записано {written} чатов ({store.kind})")
+
+
+async def history_flusher() -> None:
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+        try:
+            await flush_histories()
+        except Exception as e:
+            logger.error(f"History flush error: {e}")
+
+
+async def get_private_history(user_id: int) -> deque:
+    return await private_store.open(user_id)
+
+
+async def get_group_history(chat_id: int) -> deque:
+    return await group_store.open(chat_id)
 
 
 def is_mentioned(message: Message, bot_username: str) -> bool:
@@ -374,50 +2367,613 @@ def is_reply_to_bot(message: Message, bot_id: int) -> bool:
     )
 
 
-# ─── Health check ─────────────────────────────────────────────────────────────
+# ─── Сводка групповой переписки ──────────────────────────────────────────────
+
+GROUP_SUMMARY_PROMPT = """Ты ведёшь краткую сводку переписки фото-чата.
+Тебе дают текущую сводку (может быть пустой) и новые сообщения.
+Верни обновлённую сводку: кто о чём спрашивал, какие объективы и камеры обсуждали, к чему пришли.
+Старое и неважное сокращай. Не больше 6 предложений, без вступлений."""
+
+
+def clip(text: str, limit: int = GROUP_LINE_CHARS) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
 
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"OK")
 
-    def log_message(self, format, *args):
+class GroupContext:
+    """Сводка старой переписки группы; сами старые сообщения в запрос не идут.
+
+    Сообщения, выпавшие из окна истории, копятся и раз в GROUP_SUMMARY_BATCH
+    вливаются в сводку фоновым запросом к модели. Если запрос отброшен или
+    упал, они ждут следующего раза (не больше трёх пачек).
+
+    Сводка нужна только для ответа на упоминание, поэтому в группах, где
+    бота давно не звали, держим лишь последнюю пачку; при упоминании она
+    уходит в сводку, а текущий ответ видит её как есть. Чат, выброшенный
+    из хранилища историй, забывается и здесь.
+    """
+
+    def __init__(self, batch: int, active_ttl: float):
+        self.batch = batch
+        self.active_ttl = active_ttl
+        self._active = TTLCache(HISTORY_MAX_CHATS)
+        self._pending: dict[int, list[GroupLine]] = {}
+        # Сообщения, которые прямо сейчас вливаются в сводку
+        self._merging: dict[int, list[GroupLine]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def _key(self, chat_id: int) -> str:
+        return f"group_summary:{chat_id}"
+
+    def retire(self, chat_id: int, line: GroupLine) -> None:
+        pending = self._pending.setdefault(chat_id, [])
+        pending.append(line)
+        if self._active.get(chat_id):
+            del pending[:-self.batch * 3]
+            if len(pending) >= self.batch:
+                self._schedule(chat_id)
+        else:
+            del pending[:-self.batch]
+
+    def evict(self, chat_id: int) -> None:
+        self._pending.pop(chat_id, None)
+        self._active.pop(chat_id)
+
+    def mentioned(self, chat_id: int) -> None:
+        self._active.set(chat_id, True, self.active_ttl)
+        if len(self._pending.get(chat_id, [])) >= self.batch:
+            self._schedule(chat_id)
+
+    def pending(self, chat_id: int) -> list[GroupLine]:
+        return self._merging.get(chat_id, []) + self._pending.get(chat_id, [])
+
+    async def summary(self, chat_id: int) -> str:
+        return await state.get(self._key(chat_id)) or ""
+
+    async def drop(self, chat_id: int) -> None:
+        self._pending.pop(chat_id, None)
+        await state.delete(self._key(chat_id))
+
+    def _schedule(self, chat_id: int) -> None:
+        if chat_id in self._merging:
+            return
+        self._merging[chat_id] = self._pending.pop(chat_id, [])
+        # Фоновая работа не относится ни к трассе, ни к квоте апдейта, который её вызвал
+        task = asyncio.create_task(self._update(chat_id), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update(self, chat_id: int) -> None:
+        lines = self._merging[chat_id]
+        try:
+            summary = await self.summary(chat_id)
+            new_lines = "\n".join(f"{line.name}: {clip(line.text)}" for line in lines)
+            response = await complete(
+                purpose="summary",
+                messages=[
+                    {"role": "system", "content": GROUP_SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Сводка:\n{summary or '(пусто)'}\n\nНовые сообщения:\n{new_lines}"},
+                ],
+                max_tokens=GROUP_SUMMARY_TOKENS,
+                temperature=0.2,
+            )
+            await state.set(self._key(chat_id), response.choices[0].message.content.strip(), HISTORY_IDLE_TTL)
+            metrics.inc("lensbot_group_summaries_total", outcome="updated")
+        except Exception as e:
+            # Вернём сообщения в начало очереди — попадут в следующую сводку
+            pending = self._pending.setdefault(chat_id, [])
+            pending[:0] = lines
+            del pending[:-self.batch * 3]
+            outcome = "shed" if isinstance(e, Shed) else "error"
+            metrics.inc("lensbot_group_summaries_total", outcome=outcome)
+            if outcome == "error":
+                metrics.inc("lensbot_errors_total", source="deepseek")
+                logger.error(f"Group summary error: {e}")
+        finally:
+            del self._merging[chat_id]
+
+
+group_context = GroupContext(GROUP_SUMMARY_BATCH, GROUP_SUMMARY_ACTIVE_TTL)
+group_store.on_retire = group_context.retire
+group_store.on_evict = group_context.evict
+
+
+async def group_context_text(chat_id: int, history: deque) -> str:
+    """Сводка, ещё не вошедшие в неё сообщения и свежее окно; последнее сообщение — целиком.
+
+    Не вошедших в сводку берём не больше пачки, и всё вместе укладываем
+    в GROUP_CONTEXT_TOKENS, выкидывая самые старые строки.
+    """
+    summary = await group_context.summary(chat_id)
+    lines = (group_context.pending(chat_id) + list(history))[-(GROUP_RAW_LINES + group_context.batch):]
+    group_context.mentioned(chat_id)
+    recent = []
+    if lines:
+        recent.append(f"{lines[-1].name}: {lines[-1].text}")
+    budget = GROUP_CONTEXT_TOKENS - estimate_tokens(summary) - estimate_tokens(recent[0] if recent else "")
+    for m in reversed(lines[:-1]):
+        line = f"{m.name}: {clip(m.text)}"
+        budget -= estimate_tokens(line)
+        if budget < 0:
+            break
+        recent.insert(0, line)
+    parts = []
+    if summary:
+        parts.append(f"Сводка более ранней переписки:\n{summary}")
+    parts.append("Переписка в чате:\n" + "\n".join(recent))
+    return "\n\n".join(parts)
+
+
+# ─── Метрики подсистем ───────────────────────────────────────────────────────
+
+def collect_metrics(m: Metrics) -> None:
+    """Значения, которые подсистемы считают сами, — в общий реестр перед выдачей."""
+    m.set_counter("lensbot_cache_requests_total", lens_cache.hits, cache="lens", result="hit")
+    m.set_counter("lensbot_cache_requests_total", lens_cache.misses, cache="lens", result="miss")
+    m.set("lensbot_cache_hit_ratio", lens_cache.stats()["hit_rate"], cache="lens")
+    m.set("lensbot_cache_entries", len(lens_cache.memory), cache="lens")
+    m.set("lensbot_cache_entries", len(lens_name_memo), cache="lens_name")
+    m.set_counter("lensbot_singleflight_shared_total", lens_flight.shared)
+    for result, count in mistake_stats.items():
+        m.set_counter("lensbot_mistake_checks_total", count, result=result)
+    m.set("lensbot_history_chats", len(private_store), kind="private")
+    m.set("lensbot_history_chats", len(group_store), kind="group")
+    for stage, queued in cpu_pool.depth.items():
+        m.set("lensbot_cpu_queue_depth", queued, stage=stage)
+    m.set("lensbot_llm_queue", llm_scheduler.queued(INTERACTIVE), priority="interactive")
+    m.set("lensbot_llm_queue", llm_scheduler.queued(BACKGROUND), priority="background")
+    for name, upstream in UPSTREAMS.items():
+        m.set("lensbot_upstream_circuit_open", upstream.breaker.state != "closed", upstream=name)
+        m.set("lensbot_upstream_rate", upstream.bucket.rate, upstream=name)
+
+
+metrics.collectors.append(collect_metrics)
+
+
+# ─── HTTP-сервер: вебхук, health, метрики ────────────────────────────────────
+
+# Публичный адрес бота; если задан — апдейты приходят вебхуком, иначе long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+PORT = int(os.environ.get("PORT", 8000))
+# Простаивающее keep-alive соединение закрываем через столько секунд
+HTTP_IDLE_TIMEOUT = float(os.environ.get("HTTP_IDLE_TIMEOUT", 75))
+MAX_REQUEST_BODY = 1 << 20
+# Больше заголовков — 400, как и строка длиннее буфера StreamReader (64 KiB)
+MAX_REQUEST_HEADERS = 100
+
+# Хендлеры разбирают только обычные сообщения
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large"}
+_http_connections: set[asyncio.StreamWriter] = set()
+
+
+class BadRequest(Exception):
+    def __init__(self, status: int):
+        self.status = status
+
+
+async def read_line(reader: asyncio.StreamReader) -> bytes:
+    try:
+        return await reader.readline()
+    except ValueError:
+        # Строка не влезла в буфер StreamReader
+        raise BadRequest(400)
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict[str, str], bytes] | None:
+    """Одна HTTP/1.1-заявка из потока; None — если клиент закрыл соединение."""
+    line = await read_line(reader)
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise BadRequest(400)
+    headers = {}
+    while True:
+        line = await read_line(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_REQUEST_HEADERS:
+            raise BadRequest(400)
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise BadRequest(400)
+    if length < 0:
+        raise BadRequest(400)
+    if length > MAX_REQUEST_BODY:
+        raise BadRequest(413)
+    body = await reader.readexactly(length) if length else b""
+    return method, target.split("?")[0], headers, body
+
+
+async def handle_webhook(app: Application, headers: dict[str, str], body: bytes) -> int:
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+        headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET
+    ):
+        return 403
+    try:
+        data = json.loads(body)
+        # Апдейт — только JSON-объект; 1, "x", [] или null в очередь не пускаем
+        update = Update.de_json(data, app.bot) if isinstance(data, dict) else None
+    except (ValueError, TypeError, KeyError):
+        return 400
+    if update is None:
+        return 400
+    # Обработка идёт своим чередом; Telegram ждёт только подтверждения приёма
+    await app.update_queue.put(update)
+    metrics.inc("lensbot_webhook_updates_total")
+    return 200
+
+
+async def route(app: Application, webhook: bool, method: str, path: str,
+                headers: dict[str, str], body: bytes) -> tuple[int, str, bytes]:
+    if webhook and method == "POST" and path == WEBHOOK_PATH:
+        return await handle_webhook(app, headers, body), "text/plain", b""
+    if method in ("GET", "HEAD") and path == "/metrics":
+        return 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode()
+    if method in ("GET", "HEAD") and path in ("/", "/health"):
+        return 200, "text/plain", b"OK"
+    return 404, "text/plain", b""
+
+
+async def serve_connection(app: Application, webhook: bool,
+                           reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    _http_connections.add(writer)
+    try:
+        while True:
+            try:
+                async with asyncio.timeout(HTTP_IDLE_TIMEOUT):
+                    request = await read_request(reader)
+            except BadRequest as e:
+                method, status, content_type, body, keep_alive = "", e.status, "text/plain", b"", False
+            else:
+                if request is None:
+                    break
+                method, path, headers, payload = request
+                status, content_type, body = await route(app, webhook, method, path, headers, payload)
+                keep_alive = headers.get("connection", "").lower() != "close"
+            writer.write(
+                f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                + (body if method != "HEAD" else b"")
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (TimeoutError, ConnectionError, asyncio.IncompleteReadError):
         pass
+    finally:
+        _http_connections.discard(writer)
+        writer.close()
+
+
+async def start_http_server(app: Application, webhook: bool, port: int = PORT) -> asyncio.Server:
+    """Один asyncio-сервер на порту: /health, /metrics и, в режиме вебхука, апдейты Telegram."""
+    server = await asyncio.start_server(
+        functools.partial(serve_connection, app, webhook), "0.0.0.0", port, backlog=1024
+    )
+    logger.info(f"HTTP server on port {port}" + (f", webhook {WEBHOOK_PATH}" if webhook else ""))
+    return server
+
+
+async def stop_http_server(server: asyncio.Server) -> None:
+    server.close()
+    for writer in list(_http_connections):
+        writer.close()
+    await server.wait_closed()
+
+
+# ─── Бюджет контекста ────────────────────────────────────────────────────────
+
+# Сколько токенов промпта тратим на один запрос (без учёта ответа)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 3000))
+# Потолок для данных с сайтов внутри бюджета
+LENS_DATA_TOKEN_LIMIT = int(os.environ.get("LENS_DATA_TOKEN_LIMIT", 1200))
+# Сколько токенов отдаём на сжатую выжимку выкинутых старых реплик
+HISTORY_SUMMARY_TOKENS = int(os.environ.get("HISTORY_SUMMARY_TOKENS", 120))
+
+_cyrillic_re = re.compile(r"[а-яё]", re.I)
+_word_re = re.compile(r"[a-zа-яё0-9]{3,}", re.I)
+_sentence_re = re.compile(r"(?<=[.!?])\s+")
+
 
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка токенов без токенайзера: кириллица ~2.5 символа на токен, латиница ~4."""
+    cyrillic = len(_cyrillic_re.findall(text))
+    return int(cyrillic / 2.5 + (len(text) - cyrillic) / 4) + 1
 
-def start_health_server():
-    port = int(os.environ.get("PORT", 8000))
-    server = HTTPServer(("0.0.0.0", port), HealthHandler)
-    logger.info(f"Health check server on port {port}")
-    server.serve_forever()
+
+def message_tokens(message: dict) -> int:
+    # +4 на служебную разметку роли
+    return estimate_tokens(message["content"]) + 4
+
+
+def _stems(text: str) -> set[str]:
+    return {w[:5] for w in _word_re.findall(text.lower())}
+
+
+def summarize_turns(turns: list[dict], budget: int) -> dict | None:
+    """Выжимка старых реплик: начала вопросов пользователя, свежие первыми."""
+    questions = [t["content"][:80] for t in reversed(turns) if t["role"] == "user"]
+    summary = "Раньше в диалоге спрашивали: "
+    used = estimate_tokens(summary)
+    picked = []
+    for q in questions:
+        cost = estimate_tokens(q) + 1
+        if used + cost > budget:
+            break
+        picked.append(q)
+        used += cost
+    if not picked:
+        return None
+    return {"role": "system", "content": summary + "; ".join(picked)}
+
+
+def fit_history(history: list[dict], budget: int) -> list[dict]:
+    """Свежие реплики целиком, старые — в выжимку, всё в пределах budget."""
+    if sum(message_tokens(m) for m in history) <= budget:
+        return list(history)
+
+    turn_budget = budget - HISTORY_SUMMARY_TOKENS
+    kept = []
+    used = 0
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if used + cost > turn_budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    # Не начинаем историю с ответа без вопроса
+    while kept and kept[0]["role"] != "user":
+        kept.pop(0)
+
+    dropped = history[:len(history) - len(kept)]
+    summary = summarize_turns(dropped, min(HISTORY_SUMMARY_TOKENS, budget - used))
+    return ([summary] if summary else []) + kept
+
+
+def fit_lens_data(lens_data: str, question: str, budget: int) -> str:
+    """Режет данные с сайтов до budget, оставляя самое близкое к вопросу.
+
+    Заголовки и ссылки сохраняются всегда, характеристики и предложения
+    из обзоров ранжируются по пересечению слов с вопросом.
+    """
+    if estimate_tokens(lens_data) <= budget:
+        return lens_data
+
+    question_stems = _stems(question)
+    chunks = []  # (сайт, часть, предложение, текст, вес)
+    for s, site in enumerate(lens_data.split("\n\n---\n\n")):
+        for p, part in enumerate(site.split("\n\n")):
+            if part.startswith("[") or part.startswith("Ссылка:"):
+                chunks.append((s, p, 0, part, float("inf")))
+                continue
+            bonus = 0.5 if part.startswith("Характеристики:") else 0.0
+            for n, sentence in enumerate(_sentence_re.split(part)):
+                score = len(question_stems & _stems(sentence)) + bonus - n * 0.01
+                chunks.append((s, p, n, sentence, score))
+
+    kept = []
+    used = 0
+    for chunk in sorted(chunks, key=lambda c: c[4], reverse=True):
+        cost = estimate_tokens(chunk[3]) + 1
+        if used + cost > budget and chunk[4] != float("inf"):
+            continue
+        kept.append(chunk)
+        used += cost
+
+    sites: dict[int, dict[int, list[str]]] = {}
+    for s, p, n, text, _ in sorted(kept):
+        sites.setdefault(s, {}).setdefault(p, []).append(text)
+    return "\n\n---\n\n".join(
+        "\n\n".join(" ".join(parts) for _, parts in sorted(site.items()))
+        for _, site in sorted(sites.items())
+    )
 
 
 # ─── Построение запроса ───────────────────────────────────────────────────────
 
-def build_messages(history: list, user_text: str) -> list:
+async def build_messages(history: list, user_text: str) -> list:
     lens_data = None
 
-    if should_search(user_text):
-        lens_name = extract_lens_name(user_text)
+    with metrics.stage("search_check"):
+        keyword = await cpu_pool.run("regex", match_search, user_text)
+    if keyword:
+        logger.info(f"Поиск по ключу {keyword!r}")
+        with metrics.stage("extract_lens_name"):
+            lens_name = await extract_lens_name(user_text)
         if lens_name:
-            lens_data = fetch_lens_data(lens_name)
+            with metrics.stage("lens_lookup"):
+                lens_data = await lookup_lens_data(lens_name)
 
-    if lens_data:
-        messages = [{"role": "system", "content": SYSTEM_WITH_DATA}] + list(history)
-        messages.append({
-            "role": "system",
-            "content": f"Данные об объективе с сайтов обзоров:\n\n{lens_data}"
-        })
-    else:
-        messages = [{"role": "system", "content": SYSTEM_NO_DATA}] + list(history)
+    system = {"role": "system", "content": SYSTEM_WITH_DATA if lens_data else SYSTEM_NO_DATA}
+    user = {"role": "user", "content": user_text}
+    available = CONTEXT_TOKEN_BUDGET - message_tokens(system) - message_tokens(user)
 
-    messages.append({"role": "user", "content": user_text})
+    data = None
+    if lens_data:
+        header = "Данные об объективе с сайтов обзоров:\n\n"
+        data_budget = min(LENS_DATA_TOKEN_LIMIT, available) - estimate_tokens(header)
+        data = {"role": "system", "content": header + fit_lens_data(lens_data, user_text, data_budget)}
+        available -= message_tokens(data)
+
+    history = fit_history(list(history), max(available, 0))
+    messages = [system] + history + ([data] if data else []) + [user]
+
+    logger.info(
+        f"Контекст: ~{sum(message_tokens(m) for m in messages)} токенов "
+        f"(система {message_tokens(system)}, история {len(history)} реплик/"
+        f"{sum(message_tokens(m) for m in history)}, данные {message_tokens(data) if data else 0}, "
+        f"вопрос {message_tokens(user)}; бюджет {CONTEXT_TOKEN_BUDGET})"
+    )
     return messages
 
 
+# ─── Ответ модели ────────────────────────────────────────────────────────────
+
+# Отвечать правками одного сообщения по мере генерации
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "1") == "1"
+# Не чаще одной правки в STREAM_EDIT_INTERVAL секунд и не меньше STREAM_MIN_CHARS новых символов
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0))
+# В группе Telegram пускает ~20 сообщений в минуту, правки тоже считаются
+STREAM_GROUP_EDIT_INTERVAL = float(os.environ.get("STREAM_GROUP_EDIT_INTERVAL", 4.0))
+STREAM_MIN_CHARS = int(os.environ.get("STREAM_MIN_CHARS", 20))
+
+FAILURE_ANSWER = "Что-то сломалось, попробуй ещё раз."
+BUSY_ANSWER = "Сейчас не могу ответить, попробуй через минуту."
+
+# Время последней отправки или правки по чатам: лимит общий для всех ответов в чате
+stream_edits: dict[int, float] = {}
+# Чаты, которым недавно ответили BUSY_ANSWER на отброшенный запрос
+shed_notices = TTLCache(HISTORY_MAX_CHATS)
+
+
+def failure_answer(e: Exception) -> str:
+    return BUSY_ANSWER if isinstance(e, UpstreamUnavailable) else FAILURE_ANSWER
+
+
+def stream_edit_due(chat_id: int, now: float) -> bool:
+    # У групп и каналов id отрицательные
+    interval = STREAM_GROUP_EDIT_INTERVAL if chat_id < 0 else STREAM_EDIT_INTERVAL
+    return now - stream_edits.get(chat_id, float("-inf")) >= interval
+
+
+def stream_edit_done(chat_id: int, now: float) -> None:
+    if len(stream_edits) >= 10000:
+        for key in [k for k, t in stream_edits.items() if now - t > STREAM_GROUP_EDIT_INTERVAL]:
+            del stream_edits[key]
+    stream_edits[chat_id] = now
+
+
+async def stream_reply(message: Message, messages: list, **kwargs) -> str | None:
+    """Отправляет ответ сразу с первыми токенами и дописывает его правками.
+
+    Если Telegram перестал принимать правки, дочитывает ответ и шлёт его
+    целиком обычным сообщением. Если модель оборвалась после первой
+    отправки, недописанный ответ заменяется сообщением об ошибке и
+    возвращается None; до первой отправки ошибка летит наверх.
+    """
+    loop = asyncio.get_running_loop()
+    text = ""
+    shown = ""
+    sent = None
+    editable = True
+
+    try:
+        async for delta in stream_complete(messages=messages, **kwargs):
+            text += delta
+            if not editable or not text.strip():
+                continue
+            if sent is not None and (
+                not stream_edit_due(message.chat_id, loop.time()) or len(text) - len(shown) < STREAM_MIN_CHARS
+            ):
+                continue
+            try:
+                if sent is None:
+                    with metrics.stage("telegram_send"):
+                        sent = await message.reply_text(text)
+                else:
+                    await sent.edit_text(text)
+                shown = text
+            except TelegramError as e:
+                metrics.inc("lensbot_errors_total", source="telegram")
+                logger.warning(f"Stream edit error: {e}")
+                editable = False
+            stream_edit_done(message.chat_id, loop.time())
+    except Exception as e:
+        if sent is None:
+            raise
+        metrics.inc("lensbot_errors_total", source="deepseek")
+        logger.error(f"DeepSeek stream error после {len(text)} символов: {e}")
+        try:
+            await sent.edit_text(failure_answer(e))
+        except TelegramError:
+            try:
+                await sent.delete()
+            except TelegramError:
+                pass
+            await message.reply_text(failure_answer(e))
+        return None
+
+    answer = text.strip()
+    if sent is None:
+        await message.reply_text(answer)
+    elif editable and shown != answer:
+        try:
+            await sent.edit_text(answer)
+        except TelegramError as e:
+            logger.warning(f"Stream edit error: {e}")
+            editable = False
+        stream_edit_done(message.chat_id, loop.time())
+    if sent is not None and not editable:
+        try:
+            await sent.delete()
+        except TelegramError:
+            pass
+        await message.reply_text(answer)
+    return answer
+
+
+async def answer_with_llm(message: Message, messages: list) -> str | None:
+    """Отвечает на message ответом модели; None — если модель не ответила."""
+    try:
+        if STREAM_REPLIES:
+            return await stream_reply(message, messages, max_tokens=MAX_TOKENS, temperature=0.7)
+        response = await complete(messages=messages, max_tokens=MAX_TOKENS, temperature=0.7)
+        answer = response.choices[0].message.content.strip()
+    except Shed as e:
+        # Молча пропадать нельзя, но и флудящему на каждое сообщение не отвечаем
+        logger.info(f"Ответ пропущен: {e}")
+        if not shed_notices.get(message.chat_id):
+            shed_notices.set(message.chat_id, True, SHED_NOTICE_INTERVAL)
+            await message.reply_text(BUSY_ANSWER)
+        return None
+    except Exception as e:
+        metrics.inc("lensbot_errors_total", source="deepseek")
+        logger.error(f"DeepSeek error: {e}")
+        await message.reply_text(failure_answer(e))
+        return None
+
+    with metrics.stage("telegram_send"):
+        await message.reply_text(answer)
+    return answer
+
+
 # ─── Handlers ─────────────────────────────────────────────────────────────────
 
+def instrumented(chat_type: str):
+    """Трасса на апдейт, счётчик апдейтов в обработке и полное время ответа по типу чата.
+
+    Заодно запоминает автора апдейта для флуд-контроля запросов к модели.
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            chat = update.effective_chat
+            user = update.effective_user
+            llm_caller.set((user.id if user else None, chat.id if chat else None))
+            with traced(
+                chat_type,
+                update_id=getattr(update, "update_id", None),
+                chat_id=chat.id if chat else None,
+            ), metrics.in_flight("updates"), metrics.stage("update", chat=chat_type):
+                return await handler(update, context)
+        return wrapper
+
+    return decorator
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
         "Привет! Спрашивай про стёкла, камеры и всё такое.\n/reset — сбросить историю"
@@ -427,42 +2983,36 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    private_histories.pop(user_id, None)
-    group_histories.pop(chat_id, None)
+    private_store.drop(user_id)
+    group_store.drop(chat_id)
+    await group_context.drop(chat_id)
     await update.message.reply_text("Сброшено.")
 
 
+@instrumented("private")
 async def handle_private(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user_text = update.message.text
 
-    if is_hack_attempt(user_text):
-        logger.warning(f"Hack attempt от user {user_id}: {user_text[:100]}")
+    with metrics.stage("hack_check"):
+        rule = await cpu_pool.run("regex", match_hack, user_text)
+    if rule:
+        logger.warning(f"Hack attempt от user {user_id} ({rule!r}): {user_text[:100]}")
         await update.message.reply_text(get_hack_response())
         return
 
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
-    history = get_private_history(user_id)
-    messages = build_messages(list(history), user_text)
+    history = await get_private_history(user_id)
+    messages = await build_messages([t.as_message() for t in history], user_text)
 
-    try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=messages,
-            max_tokens=MAX_TOKENS,
-            temperature=0.7,
-        )
-        answer = response.choices[0].message.content.strip()
-        history.append({"role": "user", "content": user_text})
-        history.append({"role": "assistant", "content": answer})
-    except Exception as e:
-        logger.error(f"DeepSeek error: {e}")
-        answer = "Что-то сломалось, попробуй ещё раз."
-
-    await update.message.reply_text(answer)
+    answer = await answer_with_llm(update.message, messages)
+    if answer is not None:
+        history.append(Turn("user", user_text))
+        history.append(Turn("assistant", answer))
 
 
+@instrumented("group")
 async def handle_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
     if not message or not message.text:
@@ -474,66 +3024,125 @@ async def handle_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     bot_username = context.bot.username
     bot_id = context.bot.id
 
-    history = get_group_history(chat_id)
-    history.append({"name": user_name, "text": user_text})
+    history = await get_group_history(chat_id)
+    history.append(GroupLine(user_name, user_text))
 
     mentioned = is_mentioned(message, bot_username)
     replied = is_reply_to_bot(message, bot_id)
 
     if mentioned or replied:
-        if is_hack_attempt(user_text):
-            logger.warning(f"Hack attempt в группе {chat_id} от {user_name}: {user_text[:100]}")
+        with metrics.stage("hack_check"):
+            rule = await cpu_pool.run("regex", match_hack, user_text)
+        if rule:
+            logger.warning(f"Hack attempt в группе {chat_id} от {user_name} ({rule!r}): {user_text[:100]}")
             await message.reply_text(get_hack_response())
             return
 
         await context.bot.send_chat_action(chat_id=chat_id, action="typing")
 
-        context_text = "\n".join(
-            f"{m['name']}: {m['text']}" for m in list(history)[-15:]
-        )
-        full_query = f"Переписка в чате:\n{context_text}\n\nОтветь на последнее обращение к тебе."
-        messages = build_messages([], full_query)
+        context_text = await group_context_text(chat_id, history)
+        full_query = f"{context_text}\n\nОтветь на последнее обращение к тебе."
+        messages = await build_messages([], full_query)
+        await answer_with_llm(message, messages)
+
+    else:
+        if await should_check_mistakes(chat_id, user_text):
+            mistake_batcher.add(chat_id, user_name, message)
+
+
+# ─── Main ─────────────────────────────────────────────────────────────────────
+
+# Свой Bot API сервер вместо api.telegram.org, например "http://localhost:8081/bot"
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+# Сколько процессов-воркеров обрабатывают апдейты; при WORKERS > 1 нужен общий STATE_BACKEND
+WORKERS = int(os.environ.get("WORKERS", 1))
+# Номер воркера в дочернем процессе; None — в единственном процессе или в роутере
+WORKER_INDEX: int | None = None
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Апдейты одного чата — строго по очереди, разных чатов — параллельно.
 
+    Общий лимит PTB здесь не работает: апдейт, ждущий свой чат, не должен
+    занимать слот, поэтому лимит берётся уже после очереди чата.
+    """
+
+    def __init__(self, max_concurrent: int):
+        super().__init__(max_concurrent_updates=1 << 16)
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._chats: dict[int, tuple[asyncio.Lock, int]] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        lock, users = self._chats.get(chat.id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._chats[chat.id] = (lock, users + 1)
         try:
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=messages,
-                max_tokens=MAX_TOKENS,
-                temperature=0.7,
-            )
-            answer = response.choices[0].message.content.strip()
-        except Exception as e:
-            logger.error(f"DeepSeek error: {e}")
-            answer = "Что-то сломалось, попробуй ещё раз."
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            lock, users = self._chats[chat.id]
+            if users == 1:
+                del self._chats[chat.id]
+            else:
+                self._chats[chat.id] = (lock, users - 1)
+
+    async def initialize(self) -> None:
+        pass
 
-        await message.reply_text(answer)
+    async def shutdown(self) -> None:
+        pass
 
+
+async def on_init(app: Application) -> None:
+    if WORKER_INDEX is None:
+        app.bot_data["http_server"] = await start_http_server(app, webhook=bool(WEBHOOK_URL))
     else:
-        try:
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": MISTAKE_PROMPT},
-                    {"role": "user", "content": user_text},
-                ],
-                max_tokens=150,
-                temperature=0.1,
-            )
-            answer = response.choices[0].message.content.strip()
-            logger.info(f"Mistake check: {answer[:100]}")
-            if answer.upper() != "SKIP":
-                await message.reply_text(answer)
-        except Exception as e:
-            logger.error(f"Mistake check error: {e}")
+        # Воркер отдаёт только свои метрики: апдейты ему приносит роутер
+        app.bot_data["http_server"] = await start_http_server(app, webhook=False, port=PORT + 1 + WORKER_INDEX)
+    if HISTORY_BACKEND in ("sqlite", "shared"):
+        _background_tasks.add(asyncio.create_task(history_flusher()))
 
 
-# ─── Main ─────────────────────────────────────────────────────────────────────
+async def on_stop(app: Application) -> None:
+    await stop_http_server(app.bot_data.pop("http_server"))
+    for task in _background_tasks:
+        task.cancel()
+    await mistake_batcher.flush_all()
+    await flush_histories()
+    cpu_pool.shutdown()
 
-def main() -> None:
-    t = threading.Thread(target=start_health_server, daemon=True)
-    t.start()
 
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+async def on_shutdown(app: Application) -> None:
+    await close_http_client(app)
+    await state.close()
+
+
+def application_builder():
+    builder = Application.builder().token(TELEGRAM_TOKEN)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    return builder
+
+
+def build_application(updater: bool = True) -> Application:
+    builder = (
+        application_builder()
+        .concurrent_updates(ChatOrderedProcessor(CONCURRENT_UPDATES))
+        .post_init(on_init)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("reset", reset))
@@ -547,11 +3156,176 @@ def main() -> None:
         filters.TEXT & ~filters.COMMAND & (filters.ChatType.GROUP | filters.ChatType.SUPERGROUP),
         handle_group,
     ))
+    return app
+
+
+async def run_webhook(app: Application) -> None:
+    """Тот же жизненный цикл, что у run_polling, но апдейты приходят на наш HTTP-сервер."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        allowed_updates=ALLOWED_UPDATES,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=min(100, CONCURRENT_UPDATES * WORKERS),
+    )
+    await app.start()
+    try:
+        await stop.wait()
+    finally:
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+
+# ─── Воркеры ──────────────────────────────────────────────────────────────────
+
+def run_worker(index: int, updates) -> None:
+    """Дочерний процесс: берёт апдейты своих чатов из очереди роутера."""
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    # Останавливает роутер, присылая None; Ctrl+C в терминале достаётся всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for upstream in UPSTREAMS.values():
+        upstream.scale(1 / WORKERS)
+    asyncio.run(serve_worker(build_application(updater=False), updates))
+
+
+async def serve_worker(app: Application, updates) -> None:
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    logger.info(f"Воркер {WORKER_INDEX} запущен")
+    try:
+        while (data := await asyncio.to_thread(updates.get)) is not None:
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await app.stop()
+        await app.post_stop(app)
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+
+class WorkerPool:
+    """Процессы-воркеры, у каждого своя очередь апдейтов.
+
+    Упавший воркер замечаем при следующем апдейте его чатов: пишем в лог,
+    поднимаем новый и перекладываем ему то, что осталось в старой очереди.
+    """
+
+    def __init__(self, size: int):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.queues = [None] * size
+        self.processes = [None] * size
+        self.closed = False
+        for index in range(size):
+            self._spawn(index)
+
+    def __len__(self) -> int:
+        return len(self.processes)
+
+    def _spawn(self, index: int) -> None:
+        queue = self.ctx.Queue()
+        process = self.ctx.Process(target=run_worker, args=(index, queue), name=f"lensbot-worker-{index}")
+        process.start()
+        self.queues[index], self.processes[index] = queue, process
+
+    def _restart(self, index: int) -> None:
+        process, old = self.processes[index], self.queues[index]
+        process.join()
+        metrics.inc("lensbot_worker_restarts_total", worker=str(index))
+        logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+        self._spawn(index)
+        while True:
+            try:
+                self.queues[index].put(old.get_nowait())
+            except Empty:
+                break
+
+    def put(self, index: int, data: dict) -> None:
+        if not self.processes[index].is_alive():
+            self._restart(index)
+        self.queues[index].put(data)
+
+    def close(self) -> None:
+        """Просит воркеры доделать очередь и выйти; повторный вызов ничего не делает."""
+        if self.closed:
+            return
+        self.closed = True
+        for queue in self.queues:
+            queue.put(None)
+
+    def join(self) -> None:
+        for process in self.processes:
+            process.join()
+
+
+def build_router(pool: WorkerPool) -> Application:
+    """Приложение-роутер: получает апдейты и раскладывает их по воркерам по chat_id.
+
+    Чат всегда попадает в один и тот же воркер, а роутер обрабатывает апдейты
+    по одному, так что порядок сообщений внутри чата сохраняется.
+    """
 
-    logger.info("Starting polling")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat = update.effective_chat
+        index = (chat.id if chat else 0) % len(pool)
+        pool.put(index, update.to_dict())
+        metrics.inc("lensbot_routed_updates_total", worker=str(index))
+
+    async def start_router(app: Application) -> None:
+        app.bot_data["http_server"] = await start_http_server(app, webhook=bool(WEBHOOK_URL))
+
+    async def stop_router(app: Application) -> None:
+        await stop_http_server(app.bot_data.pop("http_server"))
+        pool.close()
+
+    app = application_builder().post_init(start_router).post_stop(stop_router).post_shutdown(close_http_client).build()
+    app.add_handler(TypeHandler(Update, route))
+    return app
+
+
+def run_router() -> None:
+    if STATE_BACKEND == "memory":
+        logger.warning("WORKERS > 1 с STATE_BACKEND=memory: флуд-контроль и кэш у каждого воркера свои")
+    pool = WorkerPool(WORKERS)
+    try:
+        app = build_router(pool)
+        if WEBHOOK_URL:
+            logger.info(f"Starting webhook {WEBHOOK_URL}, воркеров: {WORKERS}")
+            asyncio.run(run_webhook(app))
+        else:
+            logger.info(f"Starting polling, воркеров: {WORKERS}")
+            app.run_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        # Если роутер упал раньше post_stop, воркеры иначе ждали бы None вечно
+        pool.close()
+        pool.join()
+
+
+def main() -> None:
+    if sys.argv[1:2] == ["ingest"]:
+        ingest_main(sys.argv[2:])
+        return
+
+    if WORKERS > 1:
+        run_router()
+        return
+
+    app = build_application()
+    if WEBHOOK_URL:
+        logger.info(f"Starting webhook {WEBHOOK_URL}")
+        asyncio.run(run_webhook(app))
+    else:
+        logger.info("Starting polling")
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
     main()
-    